@@ -6,23 +6,29 @@ __license__ = 'GPL v3'
 __copyright__ = '2024, leoincedo based on 2021, YoungJae Hur <yjhur82 at gmail.com> based on google search by Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-import time, re, os
-from threading import Thread
-from lxml.html import fromstring
+import time, re, os, sqlite3, zlib, json, hashlib, math
+from collections import Counter, namedtuple
+from concurrent.futures import TimeoutError as FutureTimeout
+from email.message import Message
+from io import BytesIO
+from functools import lru_cache
+from html import unescape
+from threading import Thread, Event, Lock
+from lxml import etree
+from lxml.html import fromstring, document_fromstring
 
 try:
     from queue import Empty, Queue
 except ImportError:
     from Queue import Empty, Queue
 
-from calibre import as_unicode, random_user_agent
+from calibre import random_user_agent
+from calibre.constants import cache_dir, islinux
 from calibre.ebooks.metadata import check_isbn
-from calibre.ebooks.metadata.sources.base import Source
-from urllib.parse import urlparse
-from calibre.utils.localization import canonicalize_lang, get_lang
-from polyglot.builtins import iteritems, cmp
+from calibre.ebooks.metadata.sources.base import Source, Option
+from urllib.parse import urlparse, urlencode
+from polyglot.builtins import iteritems
 
-import difflib
 
 # Comparing Metadata objects for relevance {{{
 words = ("the", "a", "an", "of", "and")
@@ -30,13 +36,241 @@ prefix_pat = re.compile(r'^(%s)\s+'%("|".join(words)))
 trailing_paren_pat = re.compile(r'\(.*\)$')
 whitespace_pat = re.compile(r'\s+')
 
+# Title similarity {{{
+# Hangul-aware replacement for difflib.SequenceMatcher. Titles are reduced to
+# a volume number plus a run of jamo, and compared as bags of jamo bigrams and
+# trigrams, which costs time linear in the title length.
+subtitle_pat = re.compile(r'[:(\[]')
+bracketed_pat = re.compile(r'\([^)]*\)|\[[^\]]*\]')
+volume_word_pat = re.compile(r'(?:제\s*)?0*(\d+)\s*권|vol\.?\s*0*(\d+)', re.I)
+trailing_volume_pat = re.compile(r'\s0*(\d+)\s*$')
+# A volume number may be followed by the kind of edition: "23 특장판"
+edition_word_pat = re.compile(r'\s(?=(?:특장판|한정판|특별판|소장판|애장판|일반판|초판|개정판|리커버)(?:\s|$))')
+# "1-23권", "1~23권" and "전23권" name the volumes of a set, not one volume
+volume_range_pat = r'\d+\s*[~\-]\s*\d+\s*권|전\s*\d+\s*권'
+title_noise_chars = ' \t\r\n!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~·‧・…「」『』《》〈〉【】〔〕“”‘’～'
+_jamo_table = None
+
+def decompose_hangul(text):
+    '''
+    Split Hangul syllables into jamo and drop spacing and punctuation.
+    '''
+    global _jamo_table
+    if _jamo_table is None:
+        table = dict.fromkeys(map(ord, title_noise_chars))
+        for code in range(0xAC00, 0xD7A4):
+            idx = code - 0xAC00
+            jamo = chr(0x1100 + idx // 588) + chr(0x1161 + (idx % 588) // 28)
+            if idx % 28:
+                jamo += chr(0x11A7 + idx % 28)
+            table[code] = jamo
+        _jamo_table = table
+    return text.translate(_jamo_table)
+
+@lru_cache(maxsize=4096)
+def normalize_title(title):
+    '''
+    Return (jamo text, volume) for a title. The volume is the number of a
+    "N권"/"제N권"/"vol. N" marker or the number ending the main title, with
+    leading zeros dropped, or None. Case, spacing and punctuation are removed.
+    '''
+    if not title:
+        return ('', None)
+    text = bracketed_pat.sub(' ', title.lower())
+    volume = None
+    if '권' in text and re.search(volume_range_pat, text):
+        return (decompose_hangul(text), None)
+    match = volume_word_pat.search(text) if '권' in text or 'vol' in text else None
+    if match is not None:
+        volume = int(match.group(1) or match.group(2))
+        text = text[:match.start()] + ' ' + text[match.end():]
+    else:
+        main = edition_word_pat.split(subtitle_pat.split(text, 1)[0], 1)[0]
+        match = trailing_volume_pat.search(main)
+        if match is not None:
+            volume = int(match.group(1))
+            text = main[:match.start()] + ' ' + text[len(main):]
+    return (decompose_hangul(text), volume)
+
+def title_ngrams(text):
+    grams = Counter(map(''.join, zip(text, text[1:])))
+    grams.update(map(''.join, zip(text, text[1:], text[2:])))
+    return grams
+
+class TitleMatcher(object):
+
+    '''
+    Score candidate titles against one query title, in [0, 1]. The query is
+    normalized and split into n-grams once; a candidate is only normalized
+    and searched for the query's n-grams, so scoring a whole candidate list is
+    linear in its total length. Text similarity is the mean of the share of
+    the query's n-grams found in the candidate and their Dice coefficient, so
+    a long subtitle lowers a match without sinking it. It is weighted 0.8,
+    and a volume agreement term 0.2.
+    '''
+
+    def __init__(self, query):
+        self.text, self.volume = normalize_title(query)
+        self.grams = title_ngrams(self.text)
+        self.size = sum(self.grams.values())
+
+    def score(self, title):
+        text_score, volume_score = self.features(title)
+        return min(1.0, 0.8 * text_score + 0.2 * volume_score)
+
+    def features(self, title):
+        '''
+        Return (text similarity, volume agreement) of title, both in [0, 1].
+        '''
+        text, volume = normalize_title(title)
+        if not self.grams or not text:
+            text_score = 1.0 if text == self.text and text else 0.0
+        else:
+            common = 0
+            for g, v in self.grams.items():
+                c = text.count(g)
+                if c:
+                    common += min(v, c)
+            size = max(0, len(text) - 1) + max(0, len(text) - 2)
+            text_score = 0.5 * common / self.size + common / (self.size + size)
+
+        if self.volume is None:
+            volume_score = 1.0 if volume is None else 0.9
+        elif volume == self.volume:
+            volume_score = 1.0
+        else:
+            volume_score = 0.6 if volume is None else 0.0
+        return text_score, volume_score
+
+    def scores(self, titles):
+        return [self.score(t) for t in titles]
+
+def rank_titles(query, titles):
+    '''
+    Return the indices of titles ordered from best to worst match for query.
+    '''
+    scores = TitleMatcher(query).scores(titles)
+    return sorted(range(len(titles)), key=scores.__getitem__, reverse=True)
+
+# }}}
+
+# Edition clustering {{{
+# A search usually lists the same book more than once: the paper book, its
+# ebook (kyobo IDs starting with E) and one or more sets or bundles. Hits are
+# grouped by normalized title, volume and first author, with the set/bundle
+# wording left out, and only the preferred edition of each group is fetched.
+bundle_pat = re.compile(volume_range_pat + r'|세트|박스|합본|패키지|\bset\b|\bbox\b', re.I)
+
+def edition_key(title, author=''):
+    '''
+    Return (key, is_bundle) for a search hit. Editions of one book share the
+    key.
+    '''
+    bundle = bool(bundle_pat.search(title))
+    text, volume = normalize_title(bundle_pat.sub(' ', title) if bundle else title)
+    return (text, volume, whitespace_pat.sub('', author or '').lower()), bundle
+
+def cluster_editions(items, prefer='paper'):
+    '''
+    Group search hits, already ordered best first, into editions of the same
+    book. Returns one dict per group in the order of its best hit: the
+    preferred edition, with the others, best first, under 'alternates'.
+    Single editions come before sets and bundles, and within those prefer
+    ('paper' or 'ebook') decides.
+    '''
+    groups = {}
+    order = []
+    for rank, item in enumerate(items):
+        key, bundle = edition_key(item.get('title') or '', item.get('author'))
+        if not key[0]:
+            key = (item['kyobo'],)
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        ebook = item['kyobo'][:1] == 'E'
+        groups[key].append(((bundle, ebook != (prefer == 'ebook'), rank), item))
+
+    clusters = []
+    for key in order:
+        editions = [item for k, item in sorted(groups[key], key=lambda x: x[0])]
+        best = dict(editions[0])
+        best['alternates'] = editions[1:]
+        clusters.append(best)
+    return clusters
+
+# }}}
+
+# Ranking {{{
+# Every ordering of candidates for a query goes through one Ranker: search
+# hits in parseList(), the results of identify() and the keygen calibre sorts
+# them with. Features are computed once per candidate and turned into a plain
+# tuple, so sorting costs only tuple comparisons. Smaller keys rank first.
+RankFeatures = namedtuple('RankFeatures', 'identifier cover fields title volume comments')
+
+class Ranker(object):
+
+    '''
+    Rank the candidates of one query by, in order: an identifier equal to one
+    of the query's, a cached cover URL, all fields filled in, title
+    similarity, the same volume number and comment length. Title similarity
+    is the TitleMatcher score rounded to two places, so that the volume
+    and comment length decide between titles that score the same. Comment
+    lengths are compared in steps of about 10%.
+
+    plugin, when given, supplies test_fields() and the cover URL cache;
+    without it those two features count as satisfied.
+    '''
+
+    def __init__(self, title=None, identifiers=None, plugin=None):
+        self.matcher = TitleMatcher(title) if title else None
+        self.identifiers = [(k, v) for k, v in iteritems(identifiers or {}) if v]
+        self.plugin = plugin
+
+    def title_features(self, title):
+        if self.matcher is None:
+            return 0.0, False
+        text_score, volume_score = self.matcher.features(title)
+        return min(1.0, 0.8 * text_score + 0.2 * volume_score), volume_score == 1.0
+
+    def features(self, mi):
+        idents = mi.get_identifiers()
+        identifier = any(idents.get(k) == v for k, v in self.identifiers)
+        plugin = self.plugin
+        if plugin is None:
+            cover = fields = True
+        else:
+            cover = bool(plugin.cached_cover_url_is_reliable) and plugin.get_cached_cover_url(idents) is not None
+            fields = plugin.test_fields(mi) is None
+        title, volume = self.title_features(mi.title)
+        return RankFeatures(identifier, cover, fields, title, volume, len((mi.comments or '').strip()))
+
+    @staticmethod
+    def sort_key(f):
+        return (not f.identifier, not f.cover, not f.fields, -round(f.title, 2), not f.volume,
+                -int(math.log1p(f.comments) * 10))
+
+    def key(self, mi):
+        return self.sort_key(self.features(mi))
+
+    def hit_key(self, title):
+        '''
+        The sort key of a search hit, of which only the title is known.
+        '''
+        title, volume = self.title_features(title)
+        return (-round(title, 2), not volume)
+
+    def rank(self, candidates):
+        return sorted(candidates, key=self.key)
+
+# }}}
+
 def get_series_info(title, strings):
     #print('****** > find_prefix@0',strings)
     if not strings:
         return ""
 
     #print('****** > find_prefix@1')
-    results = sorted(strings, key=lambda x: difflib.SequenceMatcher(None, x.split(":")[0], title).ratio(), reverse=True)
+    results = [strings[i] for i in rank_titles(title, [x.split(":")[0] for x in strings])]
 
     if len(results) <= 0:
         return ""
@@ -56,14 +290,10 @@ def get_series_info(title, strings):
     name = ""
     index = 0
 
-    print("DEBUG 0")
-
     series_index = re.findall("\s+(?:\d*\.*\d+)\s*", title)
     if series_index:
-        print("DEBUG 1", series_index)
         index = float(series_index[0].strip())
-   
-    print("DEBUG :", sp, end) 
+
     if end == '상' or end =='중' or end =='하':
         isSplit = True
     
@@ -82,6 +312,111 @@ def get_series_info(title, strings):
     return (name, index)
 
 
+split_volume_indices = {'상': 1.0, '중': 2.0, '하': 3.0}
+title_volume_pat = re.compile(r'\s+(?:\d*\.*\d+)\s*')
+kyobo_id_pat = re.compile(r'^[SE]\d{9,}$')
+
+def parse_series_name(name):
+    '''
+    Split a series list entry into (series name, volume index) the way
+    get_series_info does, including the 상/중/하 volumes. The index is 0 when
+    the entry carries no volume.
+    '''
+    name = name.split(":")[0].strip()
+    name = name.replace("("," ").replace(")","")
+    sp = name.strip().split(" ")
+    end = sp[-1]
+    try:
+        index = float(int(end))
+    except ValueError:
+        index = split_volume_indices.get(end, 0)
+    if index:
+        return (" ".join(sp[0:-1]).strip(), index)
+    return (" ".join(sp), 0)
+
+def title_volume_index(title):
+    series_index = title_volume_pat.findall(title)
+    if series_index:
+        try:
+            return float(series_index[0].strip())
+        except ValueError:
+            pass
+    return split_volume_indices.get(title.strip().split(" ")[-1], 0)
+
+def series_key(name):
+    return whitespace_pat.sub('', name).lower()
+
+class SeriesInfo(object):
+
+    '''
+    One series with all of its pages merged. The volume index -> name map
+    and the names of the sub-series (외전 and the like) are built once when
+    the series is added.
+    '''
+
+    def __init__(self, names):
+        self.volumes, self.names, counts = {}, {}, {}
+        for entry in names:
+            base, index = parse_series_name(entry)
+            counts[base] = counts.get(base, 0) + 1
+            self.names.setdefault(series_key(base), base)
+            if index:
+                self.volumes.setdefault(index, base)
+        self.name = max(counts, key=counts.get) if counts else ""
+
+    def lookup(self, title):
+        index = title_volume_index(title)
+        name = self.names.get(series_key(parse_series_name(title)[0]))
+        if name is None:
+            name = self.volumes.get(index, self.name)
+        return (name, index)
+
+class SeriesCache(object):
+
+    '''
+    Series seen during this session, found by the kyobo ID of any of their
+    volumes, so that after the first volume of a series the others need no
+    request. A book whose ID is not listed is only matched when its exact
+    title is one of the volume names and its first author is the author of
+    the book the series was fetched for. find() returns False for a book
+    already known to belong to no series and None for one not seen yet.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.by_id = {}
+        self.by_title = {}
+
+    def author_key(self, author):
+        return whitespace_pat.sub('', author or '').lower()
+
+    def find(self, kyobo, title, author=None):
+        with self.lock:
+            if kyobo in self.by_id:
+                return self.by_id[kyobo]
+            author = self.author_key(author)
+            if not author or not title:
+                return None
+            for series_author, series in self.by_title.get(cleanup_title(title), ()):
+                if series_author == author:
+                    return series
+            return None
+
+    def add(self, kyobo, names, ids, author=None):
+        if not names:
+            with self.lock:
+                self.by_id[kyobo] = False
+            return None
+        series = SeriesInfo(names)
+        author = self.author_key(author)
+        with self.lock:
+            for i in ids + [kyobo]:
+                self.by_id[i] = series
+            if author:
+                for name in names:
+                    self.by_title.setdefault(cleanup_title(name), []).append((author, series))
+        return series
+
 def cleanup_title(s):
     if not s:
         s = _('Unknown')
@@ -101,90 +436,1539 @@ def getItemID(url):
     last_segment = path_segments[-1]  # 리스트의 마지막 요소
     return last_segment
 
-class Worker(Thread):  # {{{
+class FetchTask(object):  # {{{
 
-    def __init__(self, basic_data, relevance, result_queue, br, timeout, log, plugin):
-        Thread.__init__(self)
-        self.daemon = True
-        self.br, self.log, self.timeout = br, log, timeout
-        self.result_queue, self.plugin, self.kyobo = result_queue, plugin, basic_data['kyobo']
-        self.basic_rating = 0
-        self.relevance = relevance
-        if 'rating' in basic_data:
-            self.basic_rating = basic_data['rating'] 
+    '''
+    A unit of work for FetchPool. Mirrors the join()/is_alive() part of the
+    Thread API so callers can wait on tasks the way they waited on threads.
+    '''
+
+    def __init__(self):
+        self.cancelled = False
+        self.finished = Event()
 
-    def run(self):
-        url = "https://product.kyobobook.co.kr/detail/{}".format(self.kyobo)
-        if self.kyobo[0] == 'E':
-            url = "https://ebook-product.kyobobook.co.kr/dig/epd/ebook/{}".format(self.kyobo)
+    def cancel(self):
+        self.cancelled = True
 
-        self.log('WORK RUN ', url)
+    def join(self, timeout=None):
+        self.finished.wait(timeout)
+
+    def is_alive(self):
+        return not self.finished.is_set()
+
+    def execute(self, br):
         try:
-            mi = self.parseItemPage(url)
-            if mi != None:
-                mi.source_relevance = self.relevance * 100
-                self.plugin.clean_downloaded_metadata(mi)
-                self.result_queue.put(mi)
-        except:
-            self.log.exception('Failed to parse details for kyobo: {}'.format(self.kyobo))
-        #self.log('WORK END ', url, 'QUEUE: ', self.result_queue.qsize())
+            if not self.cancelled:
+                self.run(br)
+        finally:
+            self.finished.set()
 
-    def to_str(self, bytes_or_str):
-        if isinstance(bytes_or_str, bytes):
-            value = bytes_or_str.decode('utf-8')
+    def run(self, br):
+        raise NotImplementedError()
+
+    def fail(self, error):
+        '''
+        Called instead of run() when the pool could not set up a browser.
+        Tasks that report completion somewhere other than finished must do
+        so here.
+        '''
+        pass
+
+# }}}
+
+class FetchPool(object):  # {{{
+
+    '''
+    A fixed set of daemon threads fed from a work queue. Each thread owns one
+    browser for its whole lifetime, so the number of threads and connections
+    stays flat no matter how many identify calls share the pool.
+    '''
+
+    def __init__(self, size, browser_factory):
+        self.tasks = Queue()
+        self.browser_factory = browser_factory
+        self.lock = Lock()
+        self.size = 0
+        self.resize(size)
+
+    def resize(self, size):
+        size = max(1, int(size))
+        with self.lock:
+            while self.size < size:
+                t = Thread(target=self._loop, name='KyoboKr-fetch-%d' % self.size)
+                t.daemon = True
+                t.start()
+                self.size += 1
+            while self.size > size:
+                self.tasks.put(None)
+                self.size -= 1
+
+    def submit(self, task):
+        self.tasks.put(task)
+        return task
+
+    def _loop(self):
+        br = None
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            if br is None and not task.cancelled:
+                try:
+                    br = self.browser_factory()
+                except Exception as e:
+                    task.cancel()
+                    try:
+                        task.fail(e)
+                    finally:
+                        task.finished.set()
+                    continue
+            task.execute(br)
+
+# }}}
+
+class Cancelled(Exception):
+    pass
+
+class OfflineMiss(Cancelled):
+
+    '''
+    Raised in offline mode for a page that is neither cached nor stored.
+    It is handled like a cancelled request: nothing is downloaded.
+    '''
+
+class Deadline(object):  # {{{
+
+    '''
+    One time budget for a whole identify() or download_cover() call, split
+    across its stages. Each stage may run until its cumulative share of the
+    budget has passed, so time an early stage does not use is left to the
+    later ones. The deadline also expires when abort is set or, for a copy
+    made with for_task(), when one of its tasks is cancelled. check() raises
+    Cancelled in all of these cases. What the budget or abort cut short is
+    recorded for report(); tasks their caller cancelled are not.
+    '''
+
+    stages = (('search', 0.3), ('detail', 0.5), ('series', 0.1), ('cover', 0.1))
+
+    def __init__(self, total, abort=None):
+        self.start = time.time()
+        self.total = total
+        self.abort = abort
+        self.tasks = ()
+        self.ends = {}
+        share = 0
+        for stage, part in self.stages:
+            share += part
+            self.ends[stage] = self.start + total * share
+        self.lock = Lock()
+        self.cuts = {}
+
+    def for_task(self, task):
+        '''
+        A view of this deadline that also expires when task is cancelled.
+        Cuts are recorded on the shared deadline.
+        '''
+        view = object.__new__(Deadline)
+        view.__dict__.update(self.__dict__)
+        view.tasks = self.tasks + (task,)
+        return view
+
+    def end(self, stage=None):
+        return self.ends.get(stage, self.start + self.total)
+
+    def reason(self, stage=None):
+        if self.abort is not None and self.abort.is_set():
+            return 'abort'
+        if any(t.cancelled for t in self.tasks):
+            return 'cancelled'
+        if time.time() >= self.end(stage):
+            return 'budget'
+        return None
+
+    def expired(self, stage=None):
+        return self.reason(stage) is not None
+
+    def remaining(self, stage=None):
+        return max(0, self.end(stage) - time.time())
+
+    def timeout(self, stage, cap):
+        '''
+        The network timeout to use for one request of stage: cap, but never
+        beyond the end of the stage.
+        '''
+        return max(0.1, min(cap, self.remaining(stage)))
+
+    def check(self, stage, what=''):
+        reason = self.reason(stage)
+        if reason is not None:
+            self.cut(stage, reason, what)
+            raise Cancelled('%s stage %s: %s' % (stage, reason, what))
+
+    def cut(self, stage, reason, what=''):
+        if reason == 'cancelled':
+            # The caller asked for it, e.g. after an exact match; nothing was lost
+            return
+        with self.lock:
+            self.cuts.setdefault(stage, []).append((reason, what))
+
+    def report(self, log):
+        elapsed = time.time() - self.start
+        with self.lock:
+            cuts = dict(self.cuts)
+        if not cuts:
+            log.debug('Finished in %.1fs of a %ss budget' % (elapsed, self.total))
+            return
+        log.warning('Stopped after %.1fs of a %ss budget' % (elapsed, self.total))
+        for stage in sorted(cuts, key=lambda s: self.end(s)):
+            reasons = Counter(reason for reason, what in cuts[stage])
+            log.warning('  %s: %d cut (%s)' % (stage, len(cuts[stage]),
+                ', '.join('%s %d' % item for item in sorted(iteritems(reasons)))))
+            for reason, what in cuts[stage]:
+                log.debug('    %s: %s' % (reason, what))
+
+# }}}
+
+class NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class Span(object):
+
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics, self.name = metrics, name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.record(self.name, time.perf_counter() - self.start, exc_type is not None)
+        return False
+
+class Metrics(object):  # {{{
+
+    '''
+    Timing spans and counters for the stages of the identify pipeline,
+    shared by every call. Use span(name) as a context manager around a stage
+    and count(name, n) for cache hits and bytes. While disabled, span()
+    returns a shared do-nothing object and count() returns at once. In
+    jsonl mode every span is also appended to path as one JSON object per
+    line, and report() adds a summary line there instead of to the log.
+    '''
+
+    null_span = NullSpan()
+
+    def __init__(self):
+        self.lock = Lock()
+        self.enabled = False
+        self.path = None
+        self.stream = None
+        self.spans = {}
+        self.counters = {}
+
+    def configure(self, mode, path=None):
+        with self.lock:
+            self.enabled = mode in ('log', 'jsonl')
+            path = path if mode == 'jsonl' else None
+            if path != self.path:
+                if self.stream is not None:
+                    self.stream.close()
+                    self.stream = None
+                self.path = path
+
+    def span(self, name):
+        if not self.enabled:
+            return self.null_span
+        return Span(self, name)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name, elapsed, failed):
+        with self.lock:
+            stats = self.spans.get(name)
+            if stats is None:
+                stats = self.spans[name] = [0, 0.0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            stats[3] += failed
+            if self.path is not None:
+                self.write(dict(ts=round(time.time(), 3), span=name, ms=round(elapsed * 1000, 3), error=failed))
+
+    def write(self, record):
+        try:
+            if self.stream is None:
+                dirname = os.path.dirname(self.path)
+                if not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                self.stream = open(self.path, 'a', encoding='utf-8')
+            self.stream.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.stream.flush()
+        except EnvironmentError:
+            # Keep timing in memory rather than fail lookups over the file
+            self.path = None
+
+    def snapshot(self):
+        '''
+        Per-span count, total, mean and max time in milliseconds and error
+        count, the raw counters, and the cache hit rate of every endpoint
+        that has cache counters.
+        '''
+        with self.lock:
+            spans = {name: dict(count=c, total_ms=round(t * 1000, 1), mean_ms=round(t * 1000 / c, 2),
+                                max_ms=round(m * 1000, 1), errors=e)
+                     for name, (c, t, m, e) in iteritems(self.spans)}
+            counters = dict(self.counters)
+        hit_rates = {}
+        for name in counters:
+            if name.endswith('.cache_hit'):
+                prefix = name[:-len('.cache_hit')]
+                total = counters[name] + counters.get(prefix + '.cache_miss', 0)
+                hit_rates[prefix] = round(counters[name] / total, 3)
+        return dict(spans=spans, counters=counters, cache_hit_rates=hit_rates)
+
+    def report(self, log):
+        if not self.enabled:
+            return
+        snapshot = self.snapshot()
+        with self.lock:
+            if self.path is not None:
+                self.write(dict(ts=round(time.time(), 3), summary=snapshot))
+                return
+        log.info('Timing since startup:')
+        for name in sorted(snapshot['spans']):
+            s = snapshot['spans'][name]
+            log.info('  %-14s %5d x %8.2f ms  (max %.1f ms, %d errors)' % (
+                name, s['count'], s['mean_ms'], s['max_ms'], s['errors']))
+        for name in sorted(snapshot['counters']):
+            log.info('  %-24s %d' % (name, snapshot['counters'][name]))
+        for name in sorted(snapshot['cache_hit_rates']):
+            log.info('  %-24s %.1f%%' % (name + ' cache hits', snapshot['cache_hit_rates'][name] * 100))
+
+    def reset(self):
+        with self.lock:
+            self.spans.clear()
+            self.counters.clear()
+
+# }}}
+
+class SharedFetches(object):  # {{{
+
+    '''
+    Collapse concurrent fetches of the same key into one: the first caller
+    runs the download and everyone who asks for the key while it is in flight
+    waits for that result instead of opening another connection. check, when
+    given, is called while waiting and may raise to stop waiting; a waiter
+    whose owner was cancelled runs the download itself.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.flights = {}
+
+    def run(self, key, func, check=None):
+        while True:
+            with self.lock:
+                flight = self.flights.get(key)
+                owner = flight is None
+                if owner:
+                    flight = self.flights[key] = [Event(), None, None]
+            if owner:
+                break
+            while not flight[0].wait(0.2):
+                if check is not None:
+                    check()
+            if isinstance(flight[2], Cancelled):
+                # The owner ran out of its own budget, not necessarily ours
+                continue
+            if flight[2] is not None:
+                raise flight[2]
+            return flight[1]
+        try:
+            flight[1] = func()
+        except Exception as e:
+            flight[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight[0].set()
+        return flight[1]
+
+# }}}
+
+class HostBucket(object):
+
+    '''
+    Token bucket for one host. The rate grows additively after every
+    successful request, up to max_rate, and is halved whenever the host
+    answers 429/503, which also blocks it until its Retry-After has passed.
+    '''
+
+    min_rate = 0.2
+    increase = 0.1
+
+    def __init__(self, max_rate):
+        self.max_rate = self.rate = float(max_rate)
+        self.tokens = self.burst = max(1.0, self.rate)
+        self.updated = time.time()
+        self.blocked_until = 0
+
+    def reserve(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0, -self.tokens / self.rate, self.blocked_until - now)
+
+    def succeeded(self):
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttled(self, now, delay):
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.blocked_until = max(self.blocked_until, now + delay)
+
+class HostScheduler(object):  # {{{
+
+    '''
+    Per-host adaptive rate limiting shared by every request the plugin makes.
+    acquire() blocks until the host's bucket grants a request; the outcome is
+    reported back with succeeded(), throttled() or failed(), which adjust the
+    rate and feed the counters returned by stats(). A max_rate of 0 turns
+    the limiting off but keeps the counters.
+    '''
+
+    def __init__(self, max_rate=0):
+        self.lock = Lock()
+        self.max_rate = max_rate
+        self.buckets = {}
+        self.counters = {}
+
+    def count(self, host, name):
+        counters = self.counters.setdefault(host, dict(requests=0, ok=0, throttled=0, failed=0, waited=0.0))
+        counters[name] += 1
+
+    def acquire(self, host, check=None):
+        '''
+        Wait for the host's turn. The wait is slept in short slices with
+        check called between them, so a cancelled request gives its thread
+        back instead of sleeping out a long Retry-After.
+        '''
+        with self.lock:
+            self.count(host, 'requests')
+            if self.max_rate <= 0:
+                return
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = self.buckets[host] = HostBucket(self.max_rate)
+            elif bucket.max_rate != self.max_rate:
+                bucket.max_rate = float(self.max_rate)
+                bucket.rate = min(bucket.rate, bucket.max_rate)
+            delay = bucket.reserve(time.time())
+        self.sleep(host, delay, check)
+
+    def sleep(self, host, delay, check=None):
+        '''
+        Sleep delay seconds in short slices with check called between them,
+        counting the time as waited for host.
+        '''
+        start = time.time()
+        end = start + delay
+        try:
+            while True:
+                left = end - time.time()
+                if left <= 0:
+                    break
+                if check is not None:
+                    check()
+                time.sleep(min(left, 0.2))
+        finally:
+            with self.lock:
+                self.counters[host]['waited'] += min(time.time(), end) - start
+
+    def succeeded(self, host):
+        with self.lock:
+            self.count(host, 'ok')
+            if host in self.buckets:
+                self.buckets[host].succeeded()
+
+    def throttled(self, host, delay):
+        with self.lock:
+            self.count(host, 'throttled')
+            if host in self.buckets:
+                self.buckets[host].throttled(time.time(), delay)
+
+    def failed(self, host):
+        with self.lock:
+            self.count(host, 'failed')
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for host, counters in iteritems(self.counters):
+                stats[host] = dict(counters)
+                if host in self.buckets:
+                    stats[host]['rate'] = round(self.buckets[host].rate, 2)
+            return stats
+
+class CircuitBreaker(object):  # {{{
+
+    '''
+    Per-endpoint circuit breaker for optional requests such as the series
+    API. After threshold consecutive failures the circuit of an endpoint
+    opens and allow() refuses it for cooldown seconds. Then one trial call
+    is let through at a time: a success closes the circuit, a failure
+    keeps it open for another cooldown.
+    '''
+
+    threshold = 5
+    cooldown = 120
+
+    def __init__(self):
+        self.lock = Lock()
+        self.failures = Counter()
+        self.opened = {}
+
+    def allow(self, endpoint):
+        with self.lock:
+            opened = self.opened.get(endpoint)
+            if opened is None:
+                return True
+            now = time.time()
+            if now - opened < self.cooldown:
+                return False
+            # Half open: this call is the trial, the next one waits again
+            self.opened[endpoint] = now
+            return True
+
+    def succeeded(self, endpoint):
+        with self.lock:
+            self.failures.pop(endpoint, None)
+            self.opened.pop(endpoint, None)
+
+    def failed(self, endpoint):
+        '''
+        Count a failure. Returns True when this one opened the circuit.
+        '''
+        with self.lock:
+            self.failures[endpoint] += 1
+            if self.failures[endpoint] < self.threshold:
+                return False
+            tripped = endpoint not in self.opened
+            self.opened[endpoint] = time.time()
+            return tripped
+
+    def is_open(self, endpoint):
+        with self.lock:
+            return endpoint in self.opened
+
+# }}}
+
+def retry_after(error, default):
+    '''
+    Seconds to wait according to the Retry-After header of an HTTP error,
+    given either as seconds or as an HTTP date.
+    '''
+    try:
+        value = error.info().get('Retry-After')
+    except Exception:
+        value = None
+    if not value:
+        return default
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return default
+
+# }}}
+
+class HTTPStatusError(Exception):
+
+    def __init__(self, url, code, headers):
+        Exception.__init__(self, 'HTTP Error %d: %s' % (code, url))
+        self.url, self.code, self.headers = url, code, headers
+
+    def info(self):
+        # A case-insensitive view, like the headers of urllib's HTTPError
+        headers = Message()
+        for k, v in iteritems(self.headers):
+            headers[k] = v
+        return headers
+
+class AsyncHTTPEngine(object):  # {{{
+
+    '''
+    A small HTTP/1.1 client on one asyncio event loop running in its own
+    thread. Connections are kept alive and pooled per host, at most
+    per_host of them, and responses are gzip/deflate compressed on the wire.
+    fetch() is the blocking adapter used from calibre's worker threads: any
+    number of them can wait on it while the requests themselves run
+    concurrently on the loop thread.
+    '''
+
+    def __init__(self, per_host=4):
+        import asyncio
+        self.asyncio = asyncio
+        self.per_host = per_host
+        self.idle = {}
+        self.slots = {}
+        self.loop = asyncio.new_event_loop()
+        self.ssl_context = None
+        t = Thread(target=self.loop.run_forever, name='KyoboKr-asyncio')
+        t.daemon = True
+        t.start()
+
+    def fetch(self, url, headers=(), timeout=30, check=None):
+        '''
+        Download url. check, when given, is called every 0.2 seconds while
+        waiting; if it raises, the request is cancelled on the loop and its
+        connection closed.
+        '''
+        future = self.asyncio.run_coroutine_threadsafe(self.get(url, dict(headers), timeout), self.loop)
+        try:
+            if check is None:
+                return future.result(timeout)
+            end = time.time() + timeout
+            while True:
+                try:
+                    return future.result(max(0, min(0.2, end - time.time())))
+                except FutureTimeout:
+                    if time.time() >= end:
+                        raise
+                    check()
+        except Exception:
+            future.cancel()
+            raise
+
+    async def get(self, url, headers, timeout, redirects=5):
+        for i in range(redirects + 1):
+            status, rheaders, body = await self.asyncio.wait_for(self.request(url, headers), timeout)
+            if status in (301, 302, 303, 307, 308) and rheaders.get('location'):
+                from urllib.parse import urljoin
+                url = urljoin(url, rheaders['location'])
+                continue
+            if status >= 400:
+                raise HTTPStatusError(url, status, rheaders)
+            return body
+        raise HTTPStatusError(url, status, rheaders)
+
+    async def request(self, url, headers):
+        parsed = urlparse(url)
+        https = parsed.scheme == 'https'
+        port = parsed.port or (443 if https else 80)
+        host_key = (parsed.scheme, parsed.hostname, port)
+        path = (parsed.path or '/') + ('?' + parsed.query if parsed.query else '')
+        lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % parsed.netloc,
+                 'Accept-Encoding: gzip, deflate', 'Connection: keep-alive']
+        lines.extend('%s: %s' % (k, v) for k, v in iteritems(headers) if k.lower() not in ('host', 'connection', 'accept-encoding'))
+        payload = ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8')
+
+        slot = self.slots.get(host_key)
+        if slot is None:
+            slot = self.slots[host_key] = self.asyncio.Semaphore(self.per_host)
+        async with slot:
+            idle = self.idle.setdefault(host_key, [])
+            while True:
+                reused = bool(idle)
+                if reused:
+                    reader, writer = idle.pop()
+                else:
+                    reader, writer = await self.connect(parsed.hostname, port, https)
+                try:
+                    writer.write(payload)
+                    await writer.drain()
+                    status, rheaders, body, keep = await self.read_response(reader)
+                except (ConnectionError, self.asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused:
+                        # The server dropped an idle connection, use a new one
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                break
+            if keep:
+                idle.append((reader, writer))
+            else:
+                writer.close()
+        return status, rheaders, body
+
+    async def connect(self, host, port, https):
+        ssl_context = None
+        if https:
+            if self.ssl_context is None:
+                import ssl
+                self.ssl_context = ssl.create_default_context()
+            ssl_context = self.ssl_context
+        return await self.asyncio.open_connection(host, port, ssl=ssl_context)
+
+    async def read_response(self, reader):
+        status_line = await reader.readuntil(b'\r\n')
+        status = int(status_line.split()[1])
+        rheaders = {}
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            k, v = line.decode('latin-1').split(':', 1)
+            rheaders[k.strip().lower()] = v.strip()
+
+        keep = rheaders.get('connection', '').lower() != 'close'
+        if rheaders.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readuntil(b'\r\n')) != b'\r\n':
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'content-length' in rheaders:
+            body = await reader.readexactly(int(rheaders['content-length']))
+        elif status in (204, 304) or 100 <= status < 200:
+            body = b''
         else:
-            value = bytes_or_str
-        return value
+            body = await reader.read()
+            keep = False
+
+        encoding = rheaders.get('content-encoding', '').lower()
+        if encoding == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            try:
+                body = zlib.decompress(body)
+            except zlib.error:
+                body = zlib.decompress(body, -zlib.MAX_WBITS)
+        return status, rheaders, body, keep
+
+# }}}
+
+class ResponseCache(object):  # {{{
+
+    '''
+    Persistent store of raw responses, kept in an SQLite file. Entries expire
+    after a per-endpoint TTL chosen by the caller and the least recently used
+    ones are evicted once the total size goes over max_size bytes.
+    '''
+
+    def __init__(self, path, max_size):
+        self.path, self.max_size = path, max_size
+        self.lock = Lock()
+        self.conn = None
+
+    def _db(self):
+        if self.conn is None:
+            dirname = os.path.dirname(self.path)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, endpoint TEXT,'
+                         ' stored REAL, accessed REAL, size INTEGER, data BLOB)')
+            conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+            conn.commit()
+            self.conn = conn
+        return self.conn
+
+    def get(self, key, ttl):
+        now = time.time()
+        with self.lock:
+            db = self._db()
+            row = db.execute('SELECT stored, data FROM responses WHERE key=?', (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[0] > ttl:
+                db.execute('DELETE FROM responses WHERE key=?', (key,))
+                db.commit()
+                return None
+            db.execute('UPDATE responses SET accessed=? WHERE key=?', (now, key))
+            db.commit()
+        return zlib.decompress(row[1])
+
+    def put(self, key, endpoint, data):
+        now = time.time()
+        blob = zlib.compress(data)
+        with self.lock:
+            db = self._db()
+            db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                       (key, endpoint, now, now, len(blob), sqlite3.Binary(blob)))
+            self._evict(db)
+            db.commit()
+
+    def _evict(self, db):
+        total = db.execute('SELECT SUM(size) FROM responses').fetchone()[0] or 0
+        if total <= self.max_size:
+            return
+        doomed = []
+        for key, size in db.execute('SELECT key, size FROM responses ORDER BY accessed'):
+            doomed.append((key,))
+            total -= size
+            if total <= self.max_size:
+                break
+        db.executemany('DELETE FROM responses WHERE key=?', doomed)
+
+    def clear(self):
+        with self.lock:
+            db = self._db()
+            db.execute('DELETE FROM responses')
+            db.commit()
+
+# }}}
+
+class ItemPageExtractor(object):  # {{{
+
+    '''
+    Extract the fields of a detail page with a single parse. The XPath
+    expressions are compiled once, and with region=True the <head> and all
+    <script>/<style> blocks are cut out before the markup reaches lxml, which
+    leaves only a fraction of the page to build a tree for.
+
+    Calling an extractor returns a plain dict, or None when the page has no
+    product title.
+    '''
+
+    title_xpath = etree.XPath(".//span[@class='prod_title']")
+    authors_xpath = etree.XPath(".//div[@class='author']//text()")
+    publish_date_xpath = etree.XPath(".//div[@class='prod_info_text publish_date']//text()")
+    categories_xpath = etree.XPath(".//li[@class='category_list_item']//text()")
+    hidden_categories_xpath = etree.XPath(
+        ".//input[@id='dgctSaleCmdtDvsnName' or @id='largeCtgrName' or @id='middleCtgrName' or @id='subCtgrName']")
+    intro_xpath = etree.XPath(".//div[@class='intro_bottom']//div[@class='info_text']/text()")
+    rating_xpath = etree.XPath(".//input[@class='form_rating']/@value")
+    cover_xpath = etree.XPath(".//div[@class='portrait_img_box']/img/@src")
+    isbn_xpath = etree.XPath(".//tr[th[.='ISBN']]/td/text()")
+    ebook_isbn_xpath = etree.XPath(".//*[@class='prod_pordInfo_box indent']/dd[2]/em/text()")
+
+    hidden_category_ids = ('dgctSaleCmdtDvsnName', 'largeCtgrName', 'middleCtgrName', 'subCtgrName')
+    noise_pat = re.compile(r'<(script|style)\b.*?</\1\s*>', re.S | re.I)
+
+    def __init__(self, region=True):
+        self.region = region
+
+    def __call__(self, raw, fields=None):
+        if self.region:
+            record = self.extract(document_fromstring(self.body_region(raw)), fields)
+            if record is not None:
+                return record
+        return self.extract(document_fromstring(raw), fields)
+
+    def body_region(self, raw):
+        start = raw.find('<body')
+        end = raw.rfind('</body>')
+        if start < 0:
+            start = 0
+        if end < start:
+            end = len(raw)
+        return '<html>' + self.noise_pat.sub('', raw[start:end]) + '</body></html>'
+
+    def extract(self, root, fields=None):
+        '''
+        Read the fields named in fields, or all of them, from a parsed page.
+        Only the XPath expressions of the named fields are run; the title is
+        always read, as a page without one is not a product page.
+        '''
+        elems = self.title_xpath(root)
+        if not elems:
+            return None
+        record = dict(title=elems[0].text)
+        for names, reader in self.readers:
+            if fields is None or any(k in fields for k in names):
+                record.update(zip(names, reader(self, root)))
+        return record
+
+    def read_authors(self, root):
+        elems = [s.strip() for s in self.authors_xpath(root)]
+        return [item for item in elems[0:-1] if item != '' and item != '>'],
+
+    def read_publish_info(self, root):
+        elems = [s.strip() for s in self.publish_date_xpath(root)]
+        elems = [item for item in elems if item != '' and item != '>']
+        publisher = elems[0] if elems else None
+        pubdate = None
+        dates = [s for s in elems[1:] if check_date_components_in_string(s)]
+        if dates:
+            cleaned_str = dates[0].replace("·","",1).strip().replace('\n', '').replace(' ', '')
+            pubdate = cleaned_str.split('출간')[0]
+        return publisher, pubdate
+
+    def read_categories(self, root):
+        elems = self.categories_xpath(root)
+        categories = [s.strip() for s in elems]
+        categories = list(dict.fromkeys([item for item in categories if item != '' and item != '>']))
+        if len(elems) <= 0:
+            values = {}
+            for inp in self.hidden_categories_xpath(root):
+                values.setdefault(inp.get('id'), inp.get('value'))
+            categories = [values[k] for k in self.hidden_category_ids if values.get(k)]
+        return categories,
+
+    def read_comments(self, root):
+        elems = self.intro_xpath(root)
+        return (" ".join(elems) if elems else ""),
+
+    def read_rating(self, root):
+        elems = self.rating_xpath(root)
+        return (elems[0] if elems else None),
+
+    def read_cover(self, root):
+        elems = self.cover_xpath(root)
+        return (elems[0] if elems else None),
+
+    def read_isbn(self, root):
+        elems = self.isbn_xpath(root) or self.ebook_isbn_xpath(root)
+        return (elems[0] if elems else None),
+
+    readers = (
+        (('authors',), read_authors),
+        (('publisher', 'pubdate'), read_publish_info),
+        (('categories',), read_categories),
+        (('comments',), read_comments),
+        (('rating',), read_rating),
+        (('cover',), read_cover),
+        (('isbn',), read_isbn),
+    )
+
+# }}}
+
+class StructuredExtractor(object):  # {{{
 
-    def getComment(self, ref, isbn):
+    '''
+    Read the same fields as ItemPageExtractor from the structured data that a
+    detail page embeds: schema.org JSON-LD, Open Graph tags and the values of
+    the hidden and rating <input> elements. Only regular expressions and json
+    are used, no DOM is built. Fields that are not found are None.
+    '''
+
+    ld_json_pat = re.compile(r'<script[^>]+type=["\']application/ld\+json["\'][^>]*>(.*?)</script>', re.S | re.I)
+    meta_pat = re.compile(r'<meta\s[^>]*>', re.I)
+    hidden_input_pat = re.compile(r'<input\s[^>]*type=["\']hidden["\'][^>]*>', re.I)
+    rating_input_pat = re.compile(r'<input\s[^>]*class=["\']form_rating["\'][^>]*>', re.I)
+    attr_pat = re.compile(r'([\w:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+    iso_date_pat = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})')
+    site_suffix_pat = re.compile(r'\s*[|\-]\s*교보문고.*$')
+
+    def __call__(self, raw):
+        record = dict(title=None, authors=None, publisher=None, pubdate=None,
+                      categories=None, comments=None, rating=None, cover=None, isbn=None)
+        self.read_hidden_inputs(raw, record)
+        self.read_rating_input(raw, record)
+        self.read_meta(raw, record)
+        for match in self.ld_json_pat.finditer(raw):
+            try:
+                data = json.loads(match.group(1).strip())
+            except ValueError:
+                continue
+            for node in (data if isinstance(data, list) else [data]):
+                if isinstance(node, dict) and node.get('@type') in ('Book', 'Product'):
+                    self.read_ld_json(node, record)
+        return record
+
+    def attrs(self, tag):
+        return {k.lower(): unescape(a if a else b) for k, a, b in self.attr_pat.findall(tag)}
+
+    def read_hidden_inputs(self, raw, record):
+        values = {}
+        for tag in self.hidden_input_pat.findall(raw):
+            attrs = self.attrs(tag)
+            if attrs.get('id'):
+                values.setdefault(attrs['id'], attrs.get('value'))
+        categories = [values[k] for k in ItemPageExtractor.hidden_category_ids if values.get(k)]
+        if categories:
+            record['categories'] = categories
+
+    def read_rating_input(self, raw, record):
+        match = self.rating_input_pat.search(raw)
+        if match:
+            record['rating'] = self.attrs(match.group()).get('value')
+
+    def read_meta(self, raw, record):
+        for tag in self.meta_pat.findall(raw):
+            attrs = self.attrs(tag)
+            prop, content = attrs.get('property'), attrs.get('content')
+            if not content:
+                continue
+            if prop == 'og:title':
+                record['title'] = self.site_suffix_pat.sub('', content)
+            elif prop == 'og:image':
+                record['cover'] = content
+
+    def read_ld_json(self, node, record):
+        def name_of(value):
+            if isinstance(value, dict):
+                return value.get('name')
+            return value
+
+        if node.get('name'):
+            record['title'] = node['name']
+        authors = node.get('author')
+        if authors:
+            authors = authors if isinstance(authors, list) else [authors]
+            record['authors'] = [a for a in map(name_of, authors) if a]
+        if node.get('publisher'):
+            record['publisher'] = name_of(node['publisher'])
+        match = self.iso_date_pat.match(node.get('datePublished') or '')
+        if match:
+            record['pubdate'] = '%s년%02d월%02d일' % (match.group(1), int(match.group(2)), int(match.group(3)))
+        isbn = node.get('isbn') or node.get('gtin13')
+        if isbn:
+            record['isbn'] = isbn
+        image = node.get('image')
+        if isinstance(image, list):
+            image = image[0] if image else None
+        if image:
+            record['cover'] = name_of(image) if isinstance(image, dict) else image
+        if node.get('description'):
+            record['comments'] = node['description']
+        rating = node.get('aggregateRating')
+        if isinstance(rating, dict) and rating.get('ratingValue'):
+            try:
+                best = float(rating.get('bestRating') or 5)
+                record['rating'] = float(rating['ratingValue']) * 10 / best
+            except ValueError:
+                pass
+
+# }}}
+
+def extract_record(raw, region=True, backend='html'):
+    '''
+    Extract the fields of a detail page, given as bytes or str, as the
+    fast_parse and extraction_backend options say. Returns (record, names
+    of the fields read from HTML after the structured data lacked them),
+    or (None, ()) when the page has no product title. The record holds
+    only plain strings and lists of them, so that it can be sent back from
+    a ParsePool worker.
+    '''
+    if isinstance(raw, bytes):
+        raw = raw.decode('utf-8')
+    html_extract = ItemPageExtractor(region=region)
+    from_html = ()
+    if backend != 'structured':
+        record = html_extract(raw)
+    elif 'prod_title' not in raw:
+        record = None
+    else:
+        record = StructuredExtractor()(raw)
+        missing = [k for k, v in iteritems(record) if not v]
+        if missing:
+            fallback = html_extract(raw, missing)
+            if fallback is not None:
+                for k in missing:
+                    record[k] = fallback.get(k)
+                from_html = tuple(missing)
+        if not record['title']:
+            record = None
+    if record is None:
+        return None, ()
+    # XPath results are smart strings that keep their whole tree alive
+    for k, v in iteritems(record):
+        if isinstance(v, str):
+            record[k] = str(v)
+        elif isinstance(v, list):
+            record[k] = [str(x) for x in v]
+    return record, from_html
+
+class ParsePool(object):  # {{{
+
+    '''
+    Parse detail pages in worker processes, so that a large batch is not
+    held to one core by the GIL. Raw page bytes are sent to the workers and
+    the records of extract_record() come back; fetching stays in the calling
+    process. Workers are forked, as a plugin module cannot be imported
+    again by a freshly started interpreter. Forking a threaded process is
+    only safe enough on Linux; on macOS the system frameworks calibre has
+    loaded do not survive a fork, and Windows has none, so the pool is
+    Linux only.
+    '''
+
+    def __init__(self, size):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        self.size = size
+        self.executor = ProcessPoolExecutor(size, mp_context=multiprocessing.get_context('fork'))
+
+    @staticmethod
+    def available():
+        import multiprocessing
+        return islinux and 'fork' in multiprocessing.get_all_start_methods()
+
+    def extract(self, raw, region=True, backend='html', check=None):
+        future = self.executor.submit(extract_record, raw, region, backend)
+        if check is None:
+            return future.result()
+        while True:
+            try:
+                return future.result(0.2)
+            except FutureTimeout:
+                try:
+                    check()
+                except Cancelled:
+                    future.cancel()
+                    raise
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+# }}}
+
+class LookupIndex(object):  # {{{
+
+    '''
+    Persistent map from ISBN and from normalized title, author and volume to
+    kyobo ID, filled from successful identify calls so that books seen once
+    never need the search page again.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.conn = None
+
+    def _db(self):
+        if self.conn is None:
+            dirname = os.path.dirname(self.path)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('CREATE TABLE IF NOT EXISTS isbn_index (isbn TEXT PRIMARY KEY, kyobo TEXT, updated REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS title_index (key TEXT PRIMARY KEY, kyobo TEXT, updated REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS isbn_misses (isbn TEXT PRIMARY KEY, checked REAL)')
+            conn.commit()
+            self.conn = conn
+        return self.conn
+
+    def title_key(self, title, authors):
+        text, volume = normalize_title(title)
+        if not text:
+            return None
+        author = whitespace_pat.sub('', authors[0]).lower() if authors else ''
+        return '%s|%s|%s' % (text, author, volume if volume is not None else '')
+
+    def find(self, isbn=None, title=None, authors=None):
+        '''
+        The kyobo ID stored for isbn, or when no ISBN is given, for title and
+        authors. An unknown ISBN is not looked up by title, as another
+        edition of the same book would be stored under the same title key.
+        '''
+        with self.lock:
+            db = self._db()
+            if isbn:
+                row = db.execute('SELECT kyobo FROM isbn_index WHERE isbn=?', (isbn,)).fetchone()
+                return row[0] if row is not None else None
+            key = self.title_key(title, authors) if title else None
+            if key:
+                row = db.execute('SELECT kyobo FROM title_index WHERE key=?', (key,)).fetchone()
+                if row is not None:
+                    return row[0]
+        return None
+
+    def find_isbn(self, isbn, miss_ttl):
+        '''
+        The kyobo ID of isbn, False when it was not found on Kyobo within the
+        last miss_ttl seconds, or None when it is unknown.
+        '''
+        with self.lock:
+            db = self._db()
+            row = db.execute('SELECT kyobo FROM isbn_index WHERE isbn=?', (isbn,)).fetchone()
+            if row is not None:
+                return row[0]
+            row = db.execute('SELECT checked FROM isbn_misses WHERE isbn=?', (isbn,)).fetchone()
+        if row is not None and time.time() - row[0] < miss_ttl:
+            return False
         return None
 
+    def add_miss(self, isbn):
+        with self.lock:
+            db = self._db()
+            db.execute('INSERT OR REPLACE INTO isbn_misses VALUES (?, ?)', (isbn, time.time()))
+            db.commit()
+
+    def add(self, kyobo, isbn=None, title=None, authors=None):
+        now = time.time()
+        key = self.title_key(title, authors) if title else None
+        with self.lock:
+            db = self._db()
+            if isbn:
+                db.execute('INSERT OR REPLACE INTO isbn_index VALUES (?, ?, ?)', (isbn, kyobo, now))
+                db.execute('DELETE FROM isbn_misses WHERE isbn=?', (isbn,))
+            if key:
+                db.execute('INSERT OR REPLACE INTO title_index VALUES (?, ?, ?)', (key, kyobo, now))
+            db.commit()
+
+# }}}
+
+class CoverStore(object):  # {{{
+
+    '''
+    Content-addressed cover images on disk. Files are named by the SHA-1 of
+    their bytes, so covers shared by several URLs (placeholders, size
+    variants the server maps to one file) are stored once; an SQLite table
+    maps URLs to digests and drives LRU eviction past max_size bytes.
+    '''
+
+    def __init__(self, root, max_size):
+        self.root, self.max_size = root, max_size
+        self.lock = Lock()
+        self.conn = None
+
+    def _db(self):
+        if self.conn is None:
+            if not os.path.exists(self.root):
+                os.makedirs(self.root)
+            conn = sqlite3.connect(os.path.join(self.root, 'covers.sqlite'), check_same_thread=False)
+            conn.execute('CREATE TABLE IF NOT EXISTS covers (url TEXT PRIMARY KEY, digest TEXT, size INTEGER, accessed REAL)')
+            conn.commit()
+            self.conn = conn
+        return self.conn
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest + '.jpg')
+
+    def get(self, url):
+        with self.lock:
+            db = self._db()
+            row = db.execute('SELECT digest FROM covers WHERE url=?', (url,)).fetchone()
+            if row is None:
+                return None
+            try:
+                with open(self.path_for(row[0]), 'rb') as f:
+                    data = f.read()
+            except EnvironmentError:
+                db.execute('DELETE FROM covers WHERE url=?', (url,))
+                db.commit()
+                return None
+            db.execute('UPDATE covers SET accessed=? WHERE url=?', (time.time(), url))
+            db.commit()
+        return data
+
+    def put(self, url, data):
+        digest = hashlib.sha1(data).hexdigest()
+        path = self.path_for(digest)
+        with self.lock:
+            db = self._db()
+            if not os.path.exists(path):
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(path + '.tmp', path)
+            db.execute('INSERT OR REPLACE INTO covers VALUES (?, ?, ?, ?)', (url, digest, len(data), time.time()))
+            self._evict(db)
+            db.commit()
+
+    def _evict(self, db):
+        total = db.execute('SELECT SUM(size) FROM (SELECT DISTINCT digest, size FROM covers)').fetchone()[0] or 0
+        if total <= self.max_size:
+            return
+        for url, digest, size in db.execute('SELECT url, digest, size FROM covers ORDER BY accessed').fetchall():
+            db.execute('DELETE FROM covers WHERE url=?', (url,))
+            if db.execute('SELECT 1 FROM covers WHERE digest=?', (digest,)).fetchone() is None:
+                try:
+                    os.remove(self.path_for(digest))
+                except EnvironmentError:
+                    pass
+                total -= size
+            if total <= self.max_size:
+                break
+
+# }}}
+
+class PageStore(object):  # {{{
+
+    '''
+    Saved Kyobo pages, for books whose pages cannot be downloaded (19세
+    pages need a login) and for identifying without network access. Pages
+    are filed under root as detail/<kyobo id>.html and
+    series/<kyobo id>-<page>.json, and an SQLite index maps the title and
+    ISBN of every detail page to its kyobo ID. root may also be a zip
+    archive with the same layout, which is read only and indexed in memory.
+    '''
+
+    kinds = {'detail': '.html', 'series': '.json'}
+    page_id_pat = re.compile(r'kyobobook\.co\.kr/(?:detail|dig/epd/ebook)/([SE]\d{9,})')
+    file_id_pat = re.compile(r'^([SE]\d{9,})(?:-(\d+))?$')
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = Lock()
+        self.conn = None
+        self.archive = None
+
+    @property
+    def read_only(self):
+        return self.root.lower().endswith('.zip')
+
+    def _db(self):
+        if self.conn is None:
+            if self.read_only:
+                import zipfile
+                self.archive = zipfile.ZipFile(self.root)
+                conn = sqlite3.connect(':memory:', check_same_thread=False)
+            else:
+                if not os.path.exists(self.root):
+                    os.makedirs(self.root)
+                conn = sqlite3.connect(os.path.join(self.root, 'index.sqlite'), check_same_thread=False)
+            conn.execute('CREATE TABLE IF NOT EXISTS pages (kind TEXT, id TEXT, title TEXT, title_key TEXT,'
+                         ' isbn TEXT, PRIMARY KEY (kind, id))')
+            conn.execute('CREATE INDEX IF NOT EXISTS pages_isbn ON pages (isbn)')
+            conn.execute('CREATE INDEX IF NOT EXISTS pages_title_key ON pages (title_key)')
+            if self.archive is not None:
+                for name in self.archive.namelist():
+                    kind, _, filename = name.partition('/')
+                    if kind in self.kinds and filename.endswith(self.kinds[kind]):
+                        self._index(conn, kind, filename[:-len(self.kinds[kind])], self.archive.read(name))
+            conn.commit()
+            self.conn = conn
+        return self.conn
+
+    def path_for(self, kind, page_id):
+        return kind + '/' + page_id + self.kinds[kind]
+
+    def _index(self, db, kind, page_id, raw):
+        title = title_key = isbn = None
+        if kind == 'detail':
+            try:
+                record = ItemPageExtractor()(raw.decode('utf-8'))
+            except Exception:
+                record = None
+            if record is not None:
+                title, isbn = record['title'], check_isbn(record['isbn'] or '') or None
+                text, volume = normalize_title(title)
+                title_key = '%s|%s' % (text, volume if volume is not None else '')
+        db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)', (kind, page_id, title, title_key, isbn))
+
+    def get(self, kind, page_id):
+        with self.lock:
+            db = self._db()
+            if db.execute('SELECT 1 FROM pages WHERE kind=? AND id=?', (kind, page_id)).fetchone() is None:
+                return None
+            try:
+                if self.archive is not None:
+                    return self.archive.read(self.path_for(kind, page_id))
+                with open(os.path.join(self.root, self.path_for(kind, page_id)), 'rb') as f:
+                    return f.read()
+            except (KeyError, EnvironmentError):
+                return None
+
+    def put(self, kind, page_id, raw):
+        if self.read_only:
+            raise ValueError('The page store %s is an archive and read only' % self.root)
+        path = os.path.join(self.root, self.path_for(kind, page_id))
+        with self.lock:
+            db = self._db()
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path + '.tmp', 'wb') as f:
+                f.write(raw)
+            os.replace(path + '.tmp', path)
+            self._index(db, kind, page_id, raw)
+            db.commit()
+
+    def find(self, title=None, isbn=None, limit=10, min_score=0.6):
+        '''
+        Return up to limit (kyobo id, title) pairs of stored detail pages for
+        an ISBN, or else for a title: pages with the same normalized title
+        and volume, or failing that the best matches scoring min_score or more.
+        '''
+        with self.lock:
+            db = self._db()
+            if isbn:
+                rows = db.execute("SELECT id, title FROM pages WHERE kind='detail' AND isbn=?", (isbn,)).fetchall()
+                if rows:
+                    return rows[:limit]
+            if not title:
+                return []
+            text, volume = normalize_title(title)
+            rows = db.execute("SELECT id, title FROM pages WHERE kind='detail' AND title_key=?",
+                              ('%s|%s' % (text, volume if volume is not None else ''),)).fetchall()
+            if rows:
+                return rows[:limit]
+            rows = db.execute("SELECT id, title FROM pages WHERE kind='detail' AND title IS NOT NULL").fetchall()
+        matcher = TitleMatcher(title)
+        scored = sorted(((matcher.score(t), i, t) for i, t in rows), reverse=True)
+        return [(i, t) for score, i, t in scored[:limit] if score >= min_score]
+
+    def ingest(self, paths, log):
+        '''
+        Add saved pages to the store: .html files saved from a detail page
+        and .json series lists, given as files or directories to walk. The
+        kyobo ID is taken from the file name (S000123456789.html, or
+        S000123456789-1.json for the first series page) or, for detail
+        pages, from the page itself. Returns the number of pages added.
+        '''
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                for dirpath, dirnames, filenames in os.walk(path):
+                    files.extend(os.path.join(dirpath, f) for f in sorted(filenames))
+            else:
+                files.append(path)
+        added = 0
+        for path in files:
+            stem, ext = os.path.splitext(os.path.basename(path))
+            kind = 'series' if ext.lower() == '.json' else 'detail' if ext.lower() in ('.html', '.htm') else None
+            if kind is None:
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    raw = f.read()
+            except EnvironmentError:
+                log.exception('Failed to read saved page: %s' % path)
+                continue
+            match = self.file_id_pat.match(stem)
+            if kind == 'series':
+                page_id = '%s-%s' % (match.group(1), match.group(2) or 1) if match else None
+            else:
+                page_id = match.group(1) if match else None
+                if page_id is None:
+                    match = self.page_id_pat.search(raw.decode('utf-8', 'replace'))
+                    page_id = match.group(1) if match else None
+            if page_id is None:
+                log.warning('No kyobo ID for saved page, skipped: %s' % path)
+                continue
+            self.put(kind, page_id, raw)
+            added += 1
+        return added
+
+# }}}
+
+class CoverTask(FetchTask):  # {{{
+
+    '''
+    Resolve and download the cover of one kyobo ID, for prefetch_covers().
+    Its budget of timeout seconds starts when the task runs, not while it
+    waits in the pool queue.
+    '''
+
+    def __init__(self, kyobo, timeout, log, plugin, get_best_cover, abort):
+        FetchTask.__init__(self)
+        self.kyobo, self.timeout, self.log, self.plugin = kyobo, timeout, log, plugin
+        self.get_best_cover, self.abort = get_best_cover, abort
+        self.cdata = None
+
+    def run(self, br):
+        self.deadline = Deadline(self.timeout, self.abort).for_task(self)
+        url = self.plugin.resolve_cover_url(br, self.log, {'kyobo': self.kyobo}, self.timeout, self.deadline)
+        if url is not None and not self.cancelled:
+            self.cdata = self.plugin.load_cover(br, self.log, url, self.timeout, self.get_best_cover, self.deadline)
+
+# }}}
+
+class IsbnTask(FetchTask):  # {{{
+
+    '''
+    Look up the kyobo ID of one ISBN for KyoboKr.resolve_isbns(). kyobo is
+    left None when Kyobo does not know the ISBN; failed is set when the
+    lookup itself did not complete. Without a shared deadline the task gets
+    a budget of timeout seconds of its own, starting when it runs.
+    '''
+
+    def __init__(self, isbn, timeout, log, plugin, deadline=None, abort=None):
+        FetchTask.__init__(self)
+        self.isbn, self.timeout, self.log, self.plugin = isbn, timeout, log, plugin
+        self.deadline = deadline.for_task(self) if deadline is not None else None
+        self.abort = abort
+        self.kyobo = None
+        self.failed = False
+
+    def run(self, br):
+        if self.deadline is None:
+            self.deadline = Deadline(self.timeout, self.abort).for_task(self)
         try:
-            from urllib.parse import urlencode
-        except ImportError:
-            from urllib import urlencode
+            self.kyobo = self.plugin.fetch_isbn(br, self.log, self.isbn, self.timeout, self.deadline)
+        except Cancelled:
+            self.failed = True
+        except Exception:
+            self.failed = True
+            self.log.exception('Failed to look up ISBN: %s' % self.isbn)
+
+    def fail(self, error):
+        self.failed = True
+
+# }}}
+
+class CommentTask(FetchTask):  # {{{
+
+    '''
+    Fetch the long description of one ISBN from Aladin for
+    KyoboKr.enrich_comments(), after its Metadata has been delivered. The
+    text is cached per ISBN, and written into mi when it is longer than
+    the Kyobo one.
+    '''
 
+    base_url = 'https://www.aladin.co.kr/shop/product/getContents.aspx?'
+
+    def __init__(self, mi, isbn, timeout, log, plugin, abort):
+        FetchTask.__init__(self)
+        self.mi, self.isbn, self.timeout, self.log, self.plugin = mi, isbn, timeout, log, plugin
+        self.abort = abort
+
+    def run(self, br):
+        # The budget starts now, not while the task waits in the pool queue
+        self.deadline = Deadline(self.timeout, self.abort).for_task(self)
+        br = br.clone_browser()
+        br.addheaders = [h for h in br.addheaders if h[0] != 'Referer'] + [
+            ('Referer', 'https://www.aladin.co.kr/shop/wproduct.aspx?ISBN=%s' % self.isbn)]
+        breaker = KyoboKr._breaker
+        if not breaker.allow('aladin'):
+            KyoboKr._metrics.count('aladin.circuit_open')
+            self.log.debug('Aladin is failing, description skipped for ISBN: %s' % self.isbn)
+            return
+        try:
+            comment = self.getComment(br)
+        except Cancelled as e:
+            KyoboKr._metrics.count('aladin.skipped')
+            self.log.info('Description for ISBN %s skipped: %s' % (self.isbn, e))
+            return
+        except Exception:
+            self.log.exception('Failed to load description for ISBN: %s' % self.isbn)
+            if breaker.failed('aladin'):
+                self.log.warning('Aladin keeps failing, skipping descriptions for %ds' % breaker.cooldown)
+            return
+        breaker.succeeded('aladin')
+        self.plugin.store_comment(self.log, self.isbn, comment)
+        self.plugin.apply_comment(self.mi, comment)
+
+    def getComment(self, br):
         comment_list = []
 
-        comment_base_url = "https://www.aladin.co.kr/shop/product/getContents.aspx?"
-        aladin_comment_url = comment_base_url + urlencode(dict(ISBN=isbn, name='Introduce'))
-        publisher_comment_url = comment_base_url + urlencode(dict(ISBN=isbn, name='PublisherDesc'))
-        aladin_comment = self.parseComment(ref, aladin_comment_url)
-        publisher_comment = self.parseComment(ref, publisher_comment_url)
+        aladin_comment = self.parseComment(br, self.base_url + urlencode(dict(ISBN=self.isbn, name='Introduce')))
+        publisher_comment = self.parseComment(br, self.base_url + urlencode(dict(ISBN=self.isbn, name='PublisherDesc')))
 
         if aladin_comment:
             comment_list.append("책소개")
-            comment_list.append(str(aladin_comment).strip())
+            comment_list.append(aladin_comment.strip())
 
         if publisher_comment:
             comment_list.append("출판사 책소개")
-            publisher_commnet = re.sub(" 접기$", "", str(publisher_comment).strip())
-            comment_list.append(publisher_commnet.strip())
+            publisher_comment = re.sub(" 접기$", "", publisher_comment.strip())
+            comment_list.append(publisher_comment.strip())
 
         comment = "\n\n".join(comment_list)
-        comment = re.sub("\r", "", comment)
-        return comment
+        return re.sub("\r", "", comment)
 
-        # if comment_list:
-        #     comment = "\n\n".join(comment_list)
-        #     comment = re.sub("\r", "", comment)
-        #     return comment
-        #
-        # else:
-        #     return None
-
-    def parseComment(self, ref, url):
+    def parseComment(self, br, url):
         comment = ''
-        return comment
-
-        br = self.br.clone_browser()
-        br.addheaders = [
-            ('Referer', ref),
-        ]
-        raw = br.open_novisit(url, timeout=self.timeout).read()
+        raw = self.plugin.fetch(br, self.log, 'aladin', url, self.timeout, deadline=self.deadline)
         try:
             html = fromstring(raw.decode('utf-8'))
-        except:
+        except Exception:
             self.log('Comment page empty', url)
             return comment
         for comment_node in html.xpath("//div[contains(@class, 'Ere_prod_mconts_LS') and contains(text(),'책소개')]"):
@@ -192,170 +1976,267 @@ class Worker(Thread):  # {{{
             if full_length:
                 comment = full_length[0].text_content()
             else:
-                comment = comment_node.xpath("../div[contains(@class, 'Ere_prod_mconts_R')]")[0].text_content()
+                parts = comment_node.xpath("../div[contains(@class, 'Ere_prod_mconts_R')]")
+                if parts:
+                    comment = parts[0].text_content()
         return comment
 
+# }}}
+
+class SearchTask(FetchTask):  # {{{
+
+    '''
+    Fetch and parse one search result page for KyoboKr.search().
+    '''
+
+    def __init__(self, label, url, keyword, done_queue, timeout, log, plugin, deadline):
+        FetchTask.__init__(self)
+        self.label, self.url, self.keyword, self.done_queue = label, url, keyword, done_queue
+        self.timeout, self.log, self.plugin = timeout, log, plugin
+        self.deadline = deadline.for_task(self)
+        self.failed = False
+
+    def run(self, br):
+        items = []
+        try:
+            raw = self.plugin.fetch(br, self.log, 'search', self.url, self.timeout,
+                                    validate=lambda raw: b'prod_item' in raw, deadline=self.deadline)
+            with KyoboKr._metrics.span('search.parse'):
+                items = self.plugin.parseList(raw, self.log, self.keyword)
+        except Cancelled:
+            self.failed = True
+        except Exception:
+            self.failed = True
+            self.log.exception('Failed to make identify query: %r' % self.url)
+        self.done_queue.put((self, items))
+
+    def fail(self, error):
+        self.failed = True
+        self.log.error('Could not set up a browser for query %r: %s' % (self.url, error))
+        self.done_queue.put((self, []))
+
+# }}}
+
+class QueryTask(FetchTask):  # {{{
+
+    '''
+    Runs one identify() call of a batch and reports the results on done_queue.
+    '''
+
+    def __init__(self, key, query, done_queue, abort, timeout, log, plugin):
+        FetchTask.__init__(self)
+        self.key, self.query, self.done_queue = key, query, done_queue
+        self.abort, self.timeout, self.log, self.plugin = abort, timeout, log, plugin
+
+    def run(self, br):
+        rq = Queue()
+        deadline = Deadline(self.timeout, self.abort).for_task(self)
+        try:
+            self.plugin.identify(self.log, rq, self.abort, timeout=self.timeout, deadline=deadline, **self.query)
+        except Exception:
+            self.log.exception('Batch query failed: %r' % (self.query,))
+        deadline.report(self.log)
+        results = []
+        while True:
+            try:
+                results.append(rq.get_nowait())
+            except Empty:
+                break
+        self.done_queue.put((self.key, results))
+
+# }}}
+
+class Worker(FetchTask):  # {{{
+
+    def __init__(self, basic_data, relevance, result_queue, timeout, log, plugin, deadline):
+        FetchTask.__init__(self)
+        self.br, self.log, self.timeout = None, log, timeout
+        self.deadline = deadline.for_task(self)
+        self.result_queue, self.plugin, self.kyobo = result_queue, plugin, basic_data['kyobo']
+        self.basic_rating = 0
+        self.relevance = relevance
+        if 'rating' in basic_data:
+            self.basic_rating = basic_data['rating'] 
+        # Other editions of the same book, tried in order when this one fails
+        self.alternates = basic_data.get('alternates') or []
+
+    def run(self, br):
+        self.br = br
+        mi = None
+        try:
+            for edition in [None] + self.alternates:
+                if edition is not None:
+                    if self.cancelled:
+                        break
+                    self.log.info('Trying another edition: {}'.format(edition['kyobo']))
+                    self.kyobo, self.basic_rating = edition['kyobo'], edition.get('rating', 0)
+                url = self.plugin._get_book_url(self.kyobo)
+                self.log('WORK RUN ', url)
+                mi = self.parseItemPage(url)
+                if mi is not None:
+                    break
+            if mi != None and not self.cancelled:
+                mi.source_relevance = self.relevance * 100
+                self.plugin.clean_downloaded_metadata(mi)
+            else:
+                mi = None
+        except:
+            self.log.exception('Failed to parse details for kyobo: {}'.format(self.kyobo))
+        finally:
+            # Always report completion, None meaning no result
+            self.result_queue.put(mi)
+        #self.log('WORK END ', url, 'QUEUE: ', self.result_queue.qsize())
+
+    def fail(self, error):
+        self.log.error('Could not set up a browser for kyobo %s: %s' % (self.kyobo, error))
+        self.result_queue.put(None)
+
+    def to_str(self, bytes_or_str):
+        if isinstance(bytes_or_str, bytes):
+            value = bytes_or_str.decode('utf-8')
+        else:
+            value = bytes_or_str
+        return value
+
+    def extract(self, raw):
+        record, from_html = self.plugin.extract_page(self.log, raw, self.deadline)
+        if from_html:
+            self.log.debug('Fields read from HTML:', ', '.join(from_html))
+        return record
+
     def parseItemPage(self, url):
+        extract = self.extract
+        if self.plugin.known_negative(self.log, 'detail', self.kyobo):
+            self.log.info('kyobo {} had no product page a short while ago, skipped'.format(self.kyobo))
+            return
+        adult = False
         try:
-            raw = self.br.open_novisit(url, timeout=self.timeout).read().decode('utf-8')
-            html = fromstring(raw)
-            if not html.xpath("//span[@class='prod_title']"):
-                if '19세' in raw:
+            raw = self.plugin.fetch(self.br, self.log, 'detail', url, self.timeout, key=self.kyobo,
+                                    validate=lambda raw: b'prod_title' in raw,
+                                    deadline=self.deadline)
+            with KyoboKr._metrics.span('detail.parse'):
+                record = extract(raw)
+            if record is None:
+                adult = '19세'.encode('utf-8') in raw
+                if adult:
                     self.log.warning('19세 연령제한 페이지입니다.')
-                    home = os.path.expanduser('~')
-                    desktop = os.path.join(home, 'Desktop')
-                    file = os.path.join(desktop, self.kyobo + '.html')
-                    try:
-                        raw = open(file).read()
-                    except:
-                        self.log.error(file, 'not found')
-                    html = fromstring(raw)
-                    self.log.debug('loaded saved page')
+                    saved = self.plugin.saved_page(self.log, self.kyobo)
+                    if saved is None:
+                        self.log.error('Save the page as {}.html and add it to the page store'.format(self.kyobo))
+                    else:
+                        record = extract(saved)
+                        self.log.debug('loaded saved page')
             else:
                 self.log.debug('ItemQuery ', url)
-        except:
+        except Cancelled:
+            return
+        except Exception as e:
+            if getattr(e, 'code', None) in (404, 410):
+                self.plugin.remember_negative(self.log, 'detail', self.kyobo)
             self.log.exception('Failed to load item page: %r' % url)
             return
-        
-        #raw = raw.decode('utf-8')
-
-        #f = open('\\workspace\out2.txt','r')
-        #f.write(str(raw.decode('utf-8')))
-        #raw = f.read() 
-        #f.close()
-
-        
+        if record is None:
+            if not adult:
+                # A saved copy of an adult page can still be added to the page store
+                self.plugin.remember_negative(self.log, 'detail', self.kyobo)
+            self.log.error('No product title on item page: %r' % url)
+            return
 
-        print('parseItemPage', self.kyobo)
         mi = self.getMetaInstance()
         mi.set_identifier('kyobo', self.kyobo)
 
-        xhtml = fromstring(raw)
-        elems = xhtml.xpath("//span[@class='prod_title']")
-        title = elems[0].text
-        elems = xhtml.xpath("*//div[@class='author']//text()")
-        elems = [s.strip() for s in elems]
-        authors = elems[0:-1]
-        authors = filtered_list = [item for item in authors if item != '' and item != '>']
-
-        #author = " ".join(elems)
-        #author = author.strip()
-        
-        elems = xhtml.xpath("//div[@class='prod_info_text publish_date']//text()")
-        elems = [s.strip() for s in elems]
-        elems = [item for item in elems if item != '' and item != '>']
-        publisher = elems[0]
-        elems = [s for s in elems[1:] if check_date_components_in_string(s)]
-        pubdate = elems[0].replace("·","",1).strip()
-        cleaned_str = pubdate.replace('\n', '').replace(' ', '')
-        pubdate = cleaned_str.split('출간')[0]
-
-        print('pubdate @:', title, pubdate)
-        elems = xhtml.xpath("//li[@class='category_list_item']//text()")
-        categories = [s.strip() for s in elems]
-        filtered_list = [item for item in categories if item != '' and item != '>']
-        categories = list(dict.fromkeys(filtered_list))
-        
-        if len(elems) <= 0: 
-            dsvn = xhtml.xpath('//input[@id="dgctSaleCmdtDvsnName"]/@value')
-            largeCtgrName = xhtml.xpath('//input[@id="largeCtgrName"]/@value')
-            middleCtgrName = xhtml.xpath('//input[@id="middleCtgrName"]/@value')
-            subCtgrName = xhtml.xpath('//input[@id="subCtgrName"]/@value')
-            
-            strs = dsvn + largeCtgrName + middleCtgrName + subCtgrName
-            strs = [o for o in strs if o and len(o)>0]
-            print("sts : ", strs)
-
-            categories = strs
-
-
-        print('categories: ', categories)
-        
-
-        
-        desc = ""        
-        
-        elems = xhtml.xpath("//div[@class='intro_bottom']//div[@class='info_text']/text()")
-
-        if len(elems) > 0 :
-            desc = " ".join(elems)
-
-	
-        elems = xhtml.xpath("//input[@class='form_rating']/@value")
-        rating = 0
-
-        if len(elems) > 0:
-            rating = elems[0]
-        else:
+        title = record['title']
+        rating = record['rating']
+        if rating is None:
             rating = self.basic_rating
 
-        print('rating : ', rating)
-
-        elem = xhtml.xpath("""//div[@class="portrait_img_box"]/img/@src""")
+        if record['cover']:
+            mi.has_cover = self.plugin.cache_identifier_to_cover_url(self.kyobo, record['cover']) is not None
 
+        mi.authors = list(record['authors'])
 
-        if len(elem):
-            img_src = elem[0]
-            mi.has_cover = self.plugin.cache_identifier_to_cover_url(self.kyobo, img_src)  is not None
-
-        mi.authors = []
-        for o in authors :
-            mi.authors.append(o)
-
-        elem = xhtml.xpath('//tr[th[.="ISBN"]]/td/text()')
-        if len(elem) == 0 :
-            elem = xhtml.xpath('//*[@class="prod_pordInfo_box indent"]/dd[2]/em/text()')
-
-        if len(elem) > 0:
-            isbn = elem[0] 
-            mi.set_identifier('isbn', isbn )
+        isbn = record['isbn']
+        if isbn:
+            mi.set_identifier('isbn', isbn)
             mi.isbn = isbn
 
-
-        mi.comments = desc
-        mi.publisher = publisher
+        mi.comments = record['comments']
+        mi.publisher = record['publisher']
         mi.title = title
-        from calibre.utils.date import parse_only_date
-        from datetime import datetime
 
-        date_obj = datetime.strptime(pubdate, "%Y년%m월%d일")
-        formatted_date = date_obj.strftime("%Y/%m/%d")
-        mi.pubdate = parse_only_date(formatted_date)
+        pubdate = record['pubdate']
+        if pubdate:
+            from calibre.utils.date import parse_only_date
+            from datetime import datetime
 
-        for tag in categories:
+            date_obj = datetime.strptime(pubdate, "%Y년%m월%d일")
+            formatted_date = date_obj.strftime("%Y/%m/%d")
+            mi.pubdate = parse_only_date(formatted_date)
+
+        for tag in record['categories']:
             mi.tags.append(tag)
 
         mi.rating = float(rating) / 2
-        
-        query ="https://product.kyobobook.co.kr/api/gw/pdt/product/{}/series?per=20".format(self.kyobo)
-
-        try:
-            raw = self.br.clone_browser().open(query, timeout=3).read().decode('utf-8')
-        except Exception as e:
-            return as_unicode(e)
-        import json
-
-        try:
-            json_data = json.loads(raw)
-            names_list = [item['name'] for item in json_data['data']['list']]
-
-            print(names_list, len(names_list))
-            if len(names_list) > 0:
-                (name, index) = get_series_info(title, names_list)
-                print('name , ', name)
-                if len(name) > 0:
-                    mi.series = name
-                if index > 0:
-                    mi.series_index = index
-        except:
-            pass
-
-        print("SERIES :", mi.series, mi.series_index)
 
-        #print(mi) 
+        if self.cancelled:
+            return mi
+
+        series_cache = self.plugin.series_cache
+        author = mi.authors[0] if mi.authors else None
+        series = series_cache.find(self.kyobo, title, author)
+        if series is None:
+            breaker = KyoboKr._breaker
+            if not breaker.allow('series'):
+                KyoboKr._metrics.count('series.circuit_open')
+                self.log.debug('Series API is failing, series skipped')
+                return mi
+            try:
+                names, ids = self.fetchSeries()
+            except Cancelled:
+                return mi
+            except Exception:
+                self.log.exception('Failed to load series list for kyobo: {}'.format(self.kyobo))
+                if breaker.failed('series'):
+                    self.log.warning('Series API keeps failing, skipping it for %ds' % breaker.cooldown)
+                return mi
+            breaker.succeeded('series')
+            series = series_cache.add(self.kyobo, names, ids, author)
+
+        if series:
+            (name, index) = series.lookup(title)
+            if len(name) > 0:
+                mi.series = name
+            if index > 0:
+                mi.series_index = index
+
+        self.log.debug('Series:', mi.series, mi.series_index)
 
         return mi
 
+    def fetchSeries(self, per=20, max_pages=50):
+        '''
+        Walk every page of the series API for this book and return the volume
+        names together with the kyobo IDs found in the entries.
+        '''
+        names, ids = [], []
+        for page in range(1, max_pages + 1):
+            query = "https://product.kyobobook.co.kr/api/gw/pdt/product/{}/series?per={}&page={}".format(
+                self.kyobo, per, page)
+            raw = self.plugin.fetch(self.br, self.log, 'series', query, self.timeout,
+                                    key='{}:{}'.format(self.kyobo, page),
+                                    validate=lambda raw: raw.lstrip()[:1] == b'{',
+                                    deadline=self.deadline).decode('utf-8')
+            data = json.loads(raw)['data']
+            entries = [item for item in data.get('list') or [] if item['name'] not in names]
+            for item in entries:
+                names.append(item['name'])
+                ids.extend(v for v in item.values() if isinstance(v, str) and kyobo_id_pat.match(v))
+            total = data.get('totalCount', data.get('total'))
+            # A short page, or one repeating what we already have, is the last
+            if len(entries) < per or (isinstance(total, int) and len(names) >= total):
+                break
+        return names, ids
+
     def getMetaInstance(self):
         from calibre.ebooks.metadata.book.base import Metadata
         from calibre.utils.date import UNDEFINED_DATE
@@ -384,24 +2265,585 @@ class KyoboKr(Source):
     has_html_comments = False
     log = None
 
+    options = (
+        Option('max_workers', 'number', 4, _('Max concurrent downloads:'),
+               _('Number of detail pages fetched at the same time. The pool is shared by all lookups.')),
+        Option('max_search_queries', 'number', 4, _('Search variants per book:'),
+               _('How many query variants (ISBN, title and author, title, title without volume, '
+                 'part of the title) are searched at most.')),
+        Option('search_hedge_delay', 'number', 3, _('Wait before the next variant (seconds):'),
+               _('How long the variants already sent may take before the next one is searched as well. '
+                 'The next variant is searched at once when the earlier ones found nothing.')),
+        Option('search_time_budget', 'number', 20, _('Search time limit (seconds):'),
+               _('Searching stops after this long and uses the best result found so far.')),
+        Option('stream_results', 'bool', True, _('Report results as they arrive'),
+               _('Hand each book to calibre as soon as its page is read instead of after all of them.')),
+        Option('top_k', 'number', 5, _('Candidates per round:'),
+               _('Detail pages are fetched for this many of the best search hits at a time. '
+                 'More are fetched only when none of them is a confident match. 0 fetches all hits.')),
+        Option('confidence_threshold', 'number', 90, _('Confident match (%):'),
+               _('Title similarity at which a fetched candidate stops further rounds.')),
+        Option('extraction_backend', 'choices', 'html', _('Read book details from:'),
+               _('Structured data reads the JSON-LD, Open Graph and hidden fields embedded in the '
+                 'page and builds the HTML tree only for fields it could not find there.'),
+               {'html': _('HTML page'), 'structured': _('Structured data first')}),
+        Option('merge_editions', 'bool', True, _('Fetch one edition per book'),
+               _('Paper books, ebooks and sets of the same title found by one search are fetched once, '
+                 'as the preferred edition. The others are only fetched if that one fails.')),
+        Option('preferred_edition', 'choices', 'paper', _('Preferred edition:'),
+               _('Which edition is fetched when a search finds several of the same book.'),
+               {'paper': _('Paper book'), 'ebook': _('Ebook')}),
+        Option('max_search_results', 'number', 20, _('Search hits to read:'),
+               _('Stop reading a search result page after this many hits. 0 reads them all.')),
+        Option('fast_parse', 'bool', True, _('Parse only the page body'),
+               _('Cut scripts and the page head out of detail pages before parsing them.')),
+        Option('parse_processes', 'number', 0, _('Parser processes:'),
+               _('Parse detail pages in this many separate processes, for large batches on '
+                 'several cores. 0 parses them in the lookup itself. Linux only, the setting '
+                 'is ignored elsewhere.')),
+        Option('http_engine', 'choices', 'mechanize', _('HTTP engine:'),
+               _('asyncio runs all requests on one thread over kept-alive, compressed '
+                 'connections shared per Kyobo host instead of one browser per worker.'),
+               {'mechanize': _('calibre browser'), 'asyncio': _('asyncio, shared connections')}),
+        Option('connections_per_host', 'number', 4, _('Connections per host:'),
+               _('Open connections kept per Kyobo host by the asyncio engine.')),
+        Option('max_requests_per_second', 'number', 8, _('Max requests per second:'),
+               _('Upper limit on requests per Kyobo host, for all lookups together. The actual rate '
+                 'backs off when a host answers 429 or 503 and recovers slowly. 0 means no limit.')),
+        Option('max_retries', 'number', 3, _('Retries when throttled:'),
+               _('How often a request answered with 429 or 503 is retried, honouring Retry-After.')),
+        Option('batch_queries', 'number', 4, _('Books identified at once in batches:'),
+               _('Number of books identify_many() works on at the same time.')),
+        Option('use_lookup_index', 'bool', True, _('Remember identified books'),
+               _('Keep a local index of ISBNs and titles already identified, so those books skip the search page.')),
+        Option('isbn_miss_ttl', 'number', 72, _('Unknown ISBN memory (hours):'),
+               _('An ISBN Kyobo does not know is not looked up again for this long.')),
+        Option('negative_cache_ttl', 'number', 30, _('Failed lookup memory (minutes):'),
+               _('A search that found nothing, or a kyobo ID without a product page, is not tried '
+                 'again for this long. 0 disables this.')),
+        Option('enrich_comments', 'bool', False, _('Add descriptions from Aladin'),
+               _('Look up the publisher and Aladin descriptions of each result by ISBN in the background '
+                 'and use them when they are longer than the Kyobo one. Lookups that finish after '
+                 'calibre has taken the results are kept for the next time.')),
+        Option('comment_time_budget', 'number', 10, _('Description lookup time (seconds):'),
+               _('Time allowed for the background description lookup of one result.')),
+        Option('best_cover_width', 'number', 1000, _('Best cover width:'),
+               _('Image width requested when calibre asks for the best available cover.')),
+        Option('cover_cache_size', 'number', 200, _('Cover store limit (MB):'),
+               _('Least recently used covers are removed once the store grows past this size.')),
+        Option('cache_ttl_search', 'number', 24, _('Search cache (hours):'),
+               _('How long search result pages are reused. 0 disables caching them.')),
+        Option('cache_ttl_detail', 'number', 168, _('Detail page cache (hours):'),
+               _('How long book detail pages are reused. 0 disables caching them.')),
+        Option('cache_ttl_series', 'number', 168, _('Series cache (hours):'),
+               _('How long series lists are reused. 0 disables caching them.')),
+        Option('cache_ttl_comments', 'number', 720, _('Description cache (hours):'),
+               _('How long descriptions from Aladin are reused. 0 disables caching them.')),
+        Option('cache_max_size', 'number', 100, _('Cache size limit (MB):'),
+               _('Least recently used responses are removed once the cache grows past this size.')),
+        Option('page_store', 'string', '', _('Saved pages folder:'),
+               _('Folder or .zip archive of saved Kyobo pages, used for 19세 books and in offline mode. '
+                 'Empty uses a folder in the plugin cache.')),
+        Option('offline', 'bool', False, _('Work offline'),
+               _('Identify books only from saved pages, the response cache and the lookup index, '
+                 'without any network access.')),
+        Option('instrumentation', 'choices', 'off', _('Timing statistics:'),
+               _('Time every stage of a lookup and count cache hits and bytes downloaded. The totals '
+                 'go to the log after each lookup, or every measurement to metrics.jsonl in the '
+                 'plugin cache folder.'),
+               {'off': _('Off'), 'log': _('Summary in the log'), 'jsonl': _('JSON lines file')}),
+    )
+
+    _fetch_pool = None
+    _fetch_pool_lock = Lock()
+    _response_cache = None
+    _response_cache_lock = Lock()
+    _query_pool = None
+    _comment_pool = None
+    _parse_pool = None
+    _lookup_index = None
+    _cover_store = None
+    _async_engine = None
+    _series_cache = SeriesCache()
+    _shared_fetches = SharedFetches()
+    _scheduler = HostScheduler()
+    _breaker = CircuitBreaker()
+    _metrics = Metrics()
+    _recorder = None
+    _page_store = None
+    _isbn_misses = {}
+    _upstream = None
+
     @property
     def user_agent(self):
         # Pass in an index to random_user_agent() to test with a particular
         # user agent
+        return random_user_agent(allow_ie=False)
+
+    def prepare_browser(self, br):
+        br.addheaders = [
+            ('Referer', 'https://search.kyobobook.co.kr/'),
+            #('X-Requested-With', 'XMLHttpRequest'),
+            #('Cache-Control', 'no-cache'),
+            #('Pragma', 'no-cache'),
+            #('verify_ssl', 'True'),
+            ("User-Agent", "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) "
+                           "Version/14.1 Safari/605.1.15"),
+        ]
+        return br
+
+    @property
+    def fetch_pool(self):
+        size = self.prefs['max_workers']
+        with KyoboKr._fetch_pool_lock:
+            if KyoboKr._fetch_pool is None:
+                KyoboKr._fetch_pool = FetchPool(size, lambda: self.prepare_browser(self.browser))
+            elif KyoboKr._fetch_pool.size != size:
+                KyoboKr._fetch_pool.resize(size)
+        return KyoboKr._fetch_pool
+
+    @property
+    def comment_pool(self):
+        with KyoboKr._fetch_pool_lock:
+            if KyoboKr._comment_pool is None:
+                KyoboKr._comment_pool = FetchPool(2, lambda: self.prepare_browser(self.browser))
+        return KyoboKr._comment_pool
+
+    @property
+    def parse_pool(self):
+        size = int(self.prefs['parse_processes'])
+        with KyoboKr._fetch_pool_lock:
+            pool = KyoboKr._parse_pool
+            if pool is not None and pool.size != size:
+                pool.shutdown()
+                pool = KyoboKr._parse_pool = None
+            if pool is None and size > 0 and ParsePool.available():
+                pool = KyoboKr._parse_pool = ParsePool(size)
+        return pool
+
+    def extract_page(self, log, raw, deadline=None):
+        '''
+        extract_record() for a detail page, in the parse pool when
+        parse_processes is set. A pool whose worker died is dropped and the
+        page parsed here instead.
+        '''
+        region, backend = self.prefs['fast_parse'], self.prefs['extraction_backend']
+        pool = self.parse_pool
+        if pool is not None:
+            check = None if deadline is None else (lambda: deadline.check('detail', 'parse'))
+            try:
+                return pool.extract(raw, region, backend, check)
+            except Cancelled:
+                raise
+            except Exception:
+                log.exception('Parser process failed, parsing in this process')
+                with KyoboKr._fetch_pool_lock:
+                    if KyoboKr._parse_pool is pool:
+                        KyoboKr._parse_pool = None
+                pool.shutdown()
+        return extract_record(raw, region, backend)
+
+    @property
+    def response_cache(self):
+        max_size = self.prefs['cache_max_size'] * 1024 * 1024
+        with KyoboKr._response_cache_lock:
+            if KyoboKr._response_cache is None:
+                KyoboKr._response_cache = ResponseCache(
+                    os.path.join(cache_dir(), 'kyobokr', 'responses.sqlite'), max_size)
+            KyoboKr._response_cache.max_size = max_size
+        return KyoboKr._response_cache
+
+    @property
+    def lookup_index(self):
+        with KyoboKr._response_cache_lock:
+            if KyoboKr._lookup_index is None:
+                KyoboKr._lookup_index = LookupIndex(os.path.join(cache_dir(), 'kyobokr', 'index.sqlite'))
+        return KyoboKr._lookup_index
+
+    def find_known(self, log, title, authors, identifiers):
+        if not self.prefs['use_lookup_index']:
+            return None
+        try:
+            return self.lookup_index.find(check_isbn(identifiers.get('isbn', None)), title, authors)
+        except Exception:
+            log.exception('Lookup index read failed')
+
+    def remember(self, log, title, authors, identifiers, books):
+        '''
+        Record the ISBN of every result, and the query title when the best
+        result is a confident match for it.
+        '''
+        if not books or not self.prefs['use_lookup_index']:
+            return
+        try:
+            for mi in books:
+                kyobo = mi.identifiers.get('kyobo')
+                isbn = check_isbn(mi.isbn)
+                if kyobo and isbn:
+                    self.cache_isbn_to_identifier(isbn, kyobo)
+                    self.lookup_index.add(kyobo, isbn=isbn)
+            best = books[0]
+            if title and (self.is_exact_match(best, title, identifiers) or
+                    self.title_similarity(title, best) * 100 >= self.prefs['confidence_threshold']):
+                self.lookup_index.add(best.identifiers.get('kyobo'), title=title, authors=authors)
+        except Exception:
+            log.exception('Lookup index write failed')
+
+    isbn_hit_pat = re.compile(r'class="prod_item".*?(?:cmdtName_|/detail/|/ebook/)([SE]\d{9,})', re.S)
+
+    def fetch_isbn(self, br, log, isbn, timeout, deadline=None):
+        '''
+        The kyobo ID of the first hit of an ISBN search, or None. The page is
+        only scanned for the ID, it is neither parsed nor scored.
+        '''
+        url = self.create_query(log, identifiers={'isbn': isbn})
+        raw = self.fetch(br, log, 'search', url, timeout, validate=lambda raw: b'prod_item' in raw,
+                         deadline=deadline)
+        match = self.isbn_hit_pat.search(raw.decode('utf-8', 'replace'))
+        return match.group(1) if match else None
+
+    def known_isbn(self, log, isbn):
+        '''
+        The remembered answer for isbn: its kyobo ID, False when Kyobo did not
+        know it within isbn_miss_ttl, or None.
+        '''
+        kyobo = self.cached_isbn_to_identifier(isbn)
+        if kyobo:
+            return kyobo
+        miss_ttl = self.prefs['isbn_miss_ttl'] * 3600
+        if time.time() - KyoboKr._isbn_misses.get(isbn, -miss_ttl) < miss_ttl:
+            return False
+        if not self.prefs['use_lookup_index']:
+            return None
+        try:
+            return self.lookup_index.find_isbn(isbn, miss_ttl)
+        except Exception:
+            log.exception('Lookup index read failed')
+
+    def remember_isbn(self, log, isbn, kyobo):
+        if kyobo:
+            self.cache_isbn_to_identifier(isbn, kyobo)
+        else:
+            KyoboKr._isbn_misses[isbn] = time.time()
+        if not self.prefs['use_lookup_index']:
+            return
+        try:
+            if kyobo:
+                self.lookup_index.add(kyobo, isbn=isbn)
+            else:
+                self.lookup_index.add_miss(isbn)
+        except Exception:
+            log.exception('Lookup index write failed')
+
+    def resolve_isbns(self, log, isbns, abort=None, timeout=30, deadline=None):
+        '''
+        Map many ISBNs to kyobo IDs at once. Remembered answers, found or not,
+        are used without a request; the rest are looked up concurrently on the
+        fetch pool and remembered. Returns a dict from each valid ISBN, as
+        normalized by check_isbn, to its kyobo ID, False when Kyobo does not
+        have it, or None when the lookup failed or did not finish in time.
+
+        Inside a lookup, deadline is that lookup's and its search stage
+        bounds the wait. For a batch without one, every ISBN gets timeout
+        seconds from when its request starts, so a long batch is resolved
+        in full.
+        '''
+        answers, todo = {}, []
+        for isbn in dict.fromkeys(filter(None, map(check_isbn, isbns))):
+            kyobo = self.known_isbn(log, isbn)
+            if kyobo is None:
+                todo.append(isbn)
+            else:
+                answers[isbn] = kyobo
+        if not todo:
+            return answers
+        pool = self.fetch_pool
+        tasks = [pool.submit(IsbnTask(isbn, timeout, log, self, deadline, abort)) for isbn in todo]
+
+        def stopped():
+            if deadline is not None:
+                return deadline.expired('search')
+            return abort is not None and abort.is_set()
+
+        for t in tasks:
+            while t.is_alive() and not stopped():
+                t.join(0.2)
+        for t in tasks:
+            t.cancel()
+        for t in tasks:
+            if t.is_alive() or t.failed:
+                answers[t.isbn] = None
+            else:
+                answers[t.isbn] = t.kyobo or False
+                self.remember_isbn(log, t.isbn, t.kyobo)
+        log.info('Resolved %d of %d ISBNs, %d without a request' % (
+            sum(1 for k in answers.values() if k), len(answers), len(answers) - len(todo)))
+        return answers
+
+    @property
+    def async_engine(self):
+        with KyoboKr._fetch_pool_lock:
+            if KyoboKr._async_engine is None:
+                KyoboKr._async_engine = AsyncHTTPEngine(self.prefs['connections_per_host'])
+            KyoboKr._async_engine.per_host = self.prefs['connections_per_host']
+        return KyoboKr._async_engine
+
+    @property
+    def series_cache(self):
+        return KyoboKr._series_cache
+
+    @property
+    def page_store(self):
+        root = self.prefs['page_store'] or os.path.join(cache_dir(), 'kyobokr', 'pages')
+        with KyoboKr._response_cache_lock:
+            if KyoboKr._page_store is None or KyoboKr._page_store.root != root:
+                KyoboKr._page_store = PageStore(root)
+        return KyoboKr._page_store
+
+    def saved_page(self, log, kyobo):
+        '''
+        The detail page of kyobo from the page store. A page saved on the
+        Desktop as <kyobo id>.html, where earlier versions looked for it, is
+        moved into the store the first time it is asked for.
+        '''
+        store = self.page_store
+        try:
+            raw = store.get('detail', kyobo)
+        except Exception:
+            log.exception('Page store read failed')
+            raw = None
+        if raw is not None:
+            return raw
+        legacy = os.path.join(os.path.expanduser('~'), 'Desktop', kyobo + '.html')
+        if not os.path.exists(legacy):
+            return None
+        with open(legacy, 'rb') as f:
+            raw = f.read()
+        if not store.read_only:
+            try:
+                store.put('detail', kyobo, raw)
+            except Exception:
+                log.exception('Page store write failed')
+        return raw
+
+    def negative_key(self, title, authors, identifiers):
+        text, volume = normalize_title(title)
+        authors = [whitespace_pat.sub('', a).lower() for a in authors or ()]
+        return json.dumps([text, volume, authors, sorted(iteritems(identifiers or {}))], ensure_ascii=False)
+
+    def known_negative(self, log, kind, key):
+        '''
+        Whether a lookup of kind ('query' or 'detail') for key came back
+        empty within negative_cache_ttl.
+        '''
+        ttl = self.prefs['negative_cache_ttl'] * 60
+        if ttl <= 0:
+            return False
+        try:
+            hit = self.response_cache.get('negative:%s:%s' % (kind, key), ttl) is not None
+        except Exception:
+            log.exception('Response cache read failed')
+            return False
+        if hit:
+            KyoboKr._metrics.count(kind + '.negative_hit')
+        return hit
+
+    def remember_negative(self, log, kind, key):
+        if self.prefs['negative_cache_ttl'] <= 0:
+            return
+        try:
+            self.response_cache.put('negative:%s:%s' % (kind, key), 'negative', b'')
+        except Exception:
+            log.exception('Response cache write failed')
+
+    def cached_comment(self, log, isbn):
+        '''
+        The cached description of isbn, '' when Aladin had none, or None
+        when it has not been looked up within cache_ttl_comments.
+        '''
+        ttl = self.prefs['cache_ttl_comments'] * 3600
+        if ttl <= 0:
+            return None
+        try:
+            raw = self.response_cache.get('comments:' + isbn, ttl)
+        except Exception:
+            log.exception('Response cache read failed')
+            return None
+        KyoboKr._metrics.count('comments.cache_hit' if raw is not None else 'comments.cache_miss')
+        return None if raw is None else raw.decode('utf-8')
+
+    def store_comment(self, log, isbn, comment):
+        if self.prefs['cache_ttl_comments'] <= 0:
+            return
+        try:
+            self.response_cache.put('comments:' + isbn, 'comments', comment.encode('utf-8'))
+        except Exception:
+            log.exception('Response cache write failed')
+
+    def apply_comment(self, mi, comment):
+        if comment and len(comment) > len(mi.comments or ''):
+            mi.comments = comment
+
+    def enrich_comments(self, log, mi, abort=None):
+        '''
+        Give mi the longer Aladin description of its ISBN. A cached one is
+        applied at once; otherwise a CommentTask looks it up in the
+        background with comment_time_budget seconds from when it starts,
+        and the caller does not wait.
+        Returns the task, or None.
+        '''
+        isbn = check_isbn(mi.isbn)
+        if not isbn:
+            return None
+        comment = self.cached_comment(log, isbn)
+        if comment is not None:
+            self.apply_comment(mi, comment)
+            return None
+        if self.prefs['offline']:
+            return None
+        budget = self.prefs['comment_time_budget']
+        return self.comment_pool.submit(CommentTask(mi, isbn, budget, log, self, abort))
+
+    @property
+    def metrics(self):
+        KyoboKr._metrics.configure(self.prefs['instrumentation'],
+                                   os.path.join(cache_dir(), 'kyobokr', 'metrics.jsonl'))
+        return KyoboKr._metrics
+
+    def fetch(self, br, log, endpoint, url, timeout, key=None, validate=None, deadline=None):
+        '''
+        Return the raw bytes for url, served from the response cache when a
+        fresh copy exists. endpoint is one of search, detail, series or cover
+        and selects the TTL; validate can refuse to cache a bad response.
+
+        With a deadline, endpoint is also the stage whose budget the request
+        runs in: timeout is shortened to what is left of it, and the download
+        is abandoned with Cancelled once the deadline expires.
+        '''
+        metrics = KyoboKr._metrics
+        with metrics.span(endpoint + '.fetch'):
+            ttl = self.prefs.get('cache_ttl_' + endpoint, 0) * 3600
+            ckey = '%s:%s' % (endpoint, key or url)
+            if self.prefs['offline']:
+                return self.fetch_offline(log, endpoint, url, key, ckey)
+            if ttl > 0:
+                try:
+                    raw = self.response_cache.get(ckey, ttl)
+                except Exception:
+                    log.exception('Response cache read failed')
+                    raw = None
+                if raw is not None:
+                    metrics.count(endpoint + '.cache_hit')
+                    return raw
+                metrics.count(endpoint + '.cache_miss')
+
+            check = None
+            if deadline is not None:
+                check = lambda: deadline.check(endpoint, url)
+                check()
+
+            def download():
+                scheduler = KyoboKr._scheduler
+                scheduler.max_rate = self.prefs['max_requests_per_second']
+                host = urlparse(url).hostname
+                retries = self.prefs['max_retries']
+                target = url
+                if KyoboKr._upstream is not None:
+                    # Replaying recorded responses from a local stand-in
+                    target = KyoboKr._upstream + '/' + url.split('://', 1)[1]
+                for attempt in range(retries + 1):
+                    scheduler.acquire(host, check)
+                    request_timeout = timeout
+                    if deadline is not None:
+                        check()
+                        request_timeout = deadline.timeout(endpoint, timeout)
+                    try:
+                        if self.prefs['http_engine'] == 'asyncio':
+                            raw = self.async_engine.fetch(target, br.addheaders, request_timeout, check)
+                        else:
+                            raw = self.read_response(br.open_novisit(target, timeout=request_timeout), check)
+                    except Cancelled:
+                        raise
+                    except Exception as e:
+                        if deadline is not None and deadline.expired(endpoint):
+                            # Timed out because the budget ran out, not the host's fault
+                            check()
+                        if getattr(e, 'code', None) in (429, 503):
+                            delay = retry_after(e, 2 ** attempt)
+                            scheduler.throttled(host, delay)
+                            if deadline is not None and delay >= deadline.remaining(endpoint):
+                                deadline.cut(endpoint, 'budget', '%s asks to wait %.1fs: %s' % (host, delay, url))
+                                raise Cancelled('%s stage budget: throttled %s' % (endpoint, url))
+                            if attempt < retries:
+                                log.warning('%s is throttling requests, retrying in %.1fs' % (host, delay))
+                                # Also when rate limiting is off and acquire() would not wait
+                                scheduler.sleep(host, delay, check)
+                                continue
+                        else:
+                            scheduler.failed(host)
+                        raise
+                    scheduler.succeeded(host)
+                    metrics.count(endpoint + '.bytes', len(raw))
+                    if KyoboKr._recorder is not None:
+                        KyoboKr._recorder.add(endpoint, url, raw)
+                    break
+                if ttl > 0 and (validate is None or validate(raw)):
+                    try:
+                        self.response_cache.put(ckey, endpoint, raw)
+                    except Exception:
+                        log.exception('Response cache write failed')
+                return raw
+
+            return KyoboKr._shared_fetches.run(ckey, download, check)
+
+    def fetch_offline(self, log, endpoint, url, key, ckey):
+        '''
+        The offline counterpart of fetch(): the cached response whatever its
+        age, or the page from the page store, or OfflineMiss.
+        '''
+        metrics = KyoboKr._metrics
+        try:
+            raw = self.response_cache.get(ckey, float('inf'))
+        except Exception:
+            log.exception('Response cache read failed')
+            raw = None
+        if raw is None and key and endpoint in PageStore.kinds:
+            try:
+                raw = self.page_store.get(endpoint, key.replace(':', '-'))
+            except Exception:
+                log.exception('Page store read failed')
+        if raw is None:
+            metrics.count(endpoint + '.offline_miss')
+            raise OfflineMiss('Not available offline: %s' % url)
+        metrics.count(endpoint + '.cache_hit')
+        return raw
+
+    def read_response(self, response, check=None, chunk_size=64 * 1024):
+        '''
+        Read a mechanize response in chunks, calling check between them so
+        a slow transfer can be abandoned part way.
+        '''
         try:
-            return random_user_agent(allow_ie=False)
+            if check is None:
+                return response.read()
+            chunks = []
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                check()
+            return b''.join(chunks)
         finally:
-            print('user_agent', self)
+            response.close()
 
     def _get_book_url(self, args):
-        print('_get_book_url')
         url = "https://product.kyobobook.co.kr/detail/{}".format(args)
-        if self.kyobo[0] == 'E':
+        if args[0] == 'E':
             url = "https://ebook-product.kyobobook.co.kr/dig/epd/ebook/{}".format(args)
         return url
 
     def get_book_url(self, identifiers):  # {{{
-        print('get_book_url')
         if identifiers.get('kyobo', None):
             args = identifiers.get('kyobo', None)
             return 'kyobo', args, self._get_book_url(args)
@@ -412,7 +2854,6 @@ class KyoboKr(Source):
     # }}}
 
     def get_cached_cover_url(self, identifiers):  # {{{
-        print('get_cached_cover_url')
         sku = None
         if identifiers.get('kyobo', None):
             sku = identifiers.get('kyobo', None)
@@ -443,26 +2884,22 @@ class KyoboKr(Source):
             return text
 
     def create_query(self, log, title=None, authors=None, identifiers={}):
-        print('query')
         try:
             from urllib.parse import urlencode
         except ImportError:
             from urllib import urlencode
 
         self.log = log 
-        log.info('CREATE_QUERY @2', identifiers)
         BASE_URL = "https://search.kyobobook.co.kr/search?"
         params = {
             #'ViewRowCount': 50,  # 50 results are the maximum
         }
         #isbn = None
         isbn = check_isbn(identifiers.get('isbn', None))
-        log.info('CREATE_QUERY @2', title, isbn)
         if isbn:
             params['KeyISBN'] = isbn
             return BASE_URL + urlencode(params)
         elif title or authors:
-            log.info('CREATE_QUERY@2')
             params['keyword'] = []
             title2 = self.replace_number_at_end(title)
             if authors != None:
@@ -471,8 +2908,7 @@ class KyoboKr(Source):
 
             if title_tokens:
                 params['keyword'].extend(title_tokens)"""
-            log.info('debug :' + title2)
-            log.info(params['keyword'])
+            log.debug('Search keyword:', title2)
 
             # author_tokens = self.get_author_tokens(authors, only_first_author=True)
 
@@ -487,194 +2923,512 @@ class KyoboKr(Source):
 
     # }}}
 
-    def identify_results_keygen(self, title, authors, identifiers ):
-
-        print('@@@@@keygen : ', identifiers)
-        def keygen(mi):
-            return InternalMetadataCompareKeyGen(mi, self, title, authors,
-                identifiers)
-        return keygen
-
+    def identify_results_keygen(self, title=None, authors=None, identifiers={}):
+        return Ranker(title, identifiers, self).key
+
+    list_title_xpath = etree.XPath(".//span[contains(@id, 'cmdtName')]")
+    list_href_xpath = etree.XPath('.//a/@href')
+    list_rating_xpath = etree.XPath('.//span[@class="review_klover_text font_size_xxs"]/text()')
+    list_author_xpath = etree.XPath(".//a[contains(concat(' ', normalize-space(@class), ' '), ' author ')]/text()")
+
+    def iterList(self, raw, limit=0):
+        '''
+        Yield the search hits of a result page one by one, each as soon as
+        the parser has read its prod_item. Items already handled are dropped
+        from the tree, so memory stays flat, and parsing stops after limit
+        hits when limit is set.
+        '''
+        if isinstance(raw, str):
+            raw = raw.encode('utf-8')
+        count = 0
+        for event, prod_item in etree.iterparse(BytesIO(raw), events=('end',), tag='li',
+                                                html=True, encoding='utf-8', recover=True):
+            if prod_item.get('class') != 'prod_item':
+                continue
+            title = self.list_title_xpath(prod_item)
+            hrefs = self.list_href_xpath(prod_item)
+            rating = self.list_rating_xpath(prod_item)
+            if title and hrefs:
+                count += 1
+                author = self.list_author_xpath(prod_item)
+                yield dict(title=title[0].text or '', url=hrefs[0], itemId=getItemID(hrefs[0]),
+                           rating=float(rating[0]) if len(rating) > 0 else 0,
+                           author=author[0].strip() if author else '')
+            prod_item.clear()
+            while prod_item.getprevious() is not None:
+                del prod_item.getparent()[0]
+            if limit and count >= limit:
+                break
 
     def parseList(self, raw, log, keyword=''):
-        xhtml = fromstring(raw)
-        print('parselist', xhtml)
-        print('parselist@@@@@@@@@@@@@@', flush=True)
-        
-        items = []
-        sorted_books = []
-        for prod_item in xhtml.xpath("//li[@class='prod_item']"):
-            #print(prod_item.text)
-            title = prod_item.xpath(".//span[contains(@id, 'cmdtName')]")
-            hrefs = prod_item.xpath('.//a/@href')
-            rating = prod_item.xpath('//span[@class="review_klover_text font_size_xxs"]/text()')
-
-            item = {}
-
-            item['title'] = title[0].text
-            item['url'] = hrefs[0]
-            item['score'] = 0
-            item['rating'] = float(rating[0]) if len(rating) > 0 else [0]
-            item['itemId'] = getItemID( hrefs[0] )
-
-            answer_bytes = bytes(keyword, 'utf-8')
-            input_bytes = bytes(item['title'], 'utf-8')
-            answer_bytes_list = list(answer_bytes)
-            input_bytes_list = list(input_bytes)
-
-            sm = difflib.SequenceMatcher(None, answer_bytes_list, input_bytes_list)
-            similar = sm.ratio()
-            item['score'] = similar
-            items.append(item)
-
-            sorted_books = sorted(items, key=lambda x: x['score'], reverse=True)
-
-        log.info('sorted : ',sorted_books)
-
-
-        return [dict(kyobo=x['itemId'], rating=x['rating']) for x in sorted_books]
-        
+        items = list(self.iterList(raw, limit=self.prefs['max_search_results']))
+        ranker = Ranker(keyword)
+        sorted_books = sorted(items, key=lambda x: ranker.hit_key(x['title']))
+
+        log.debug('Search hits:', len(sorted_books))
+
+        return [dict(kyobo=x['itemId'], rating=x['rating'], title=x['title'], author=x['author']) for x in sorted_books]
+
+    def plan_queries(self, log, title, authors, identifiers):
+        '''
+        Return the search queries worth trying for a book as (label, URL)
+        pairs, best first: ISBN, title with author, title alone, the title
+        without its volume number and finally part of the title. A URL that
+        an earlier query already produced is not repeated.
+        '''
+        plans = []
+        isbn = check_isbn(identifiers.get('isbn', None))
+        if isbn:
+            plans.append(('isbn', self.create_query(log, identifiers={'isbn': isbn})))
+        if title:
+            if authors:
+                plans.append(('title+author', self.create_query(log, title=title, authors=authors)))
+            plans.append(('title', self.create_query(log, title=title)))
+            base, index = parse_series_name(title)
+            if index and base:
+                plans.append(('title without volume', self.create_query(log, title=base)))
+            sp = title.split(" ")
+            if len(sp) > 1:
+                plans.append(('partial title', self.create_query(log, title=" ".join(sp[1:3]))))
+        seen = set()
+        unique = []
+        for label, url in plans:
+            if url and url not in seen:
+                seen.add(url)
+                unique.append((label, url))
+        return unique
+
+    def search(self, log, abort, title, authors, identifiers, timeout, deadline=None):
+        '''
+        Run the planned queries, at most max_search_queries of them and
+        within search_time_budget seconds or the search stage of deadline,
+        whichever ends first. The best query is sent first; each fallback is
+        only sent once the queries before it have all come back empty, or
+        have taken longer than search_hedge_delay, so that a book found by
+        its first query costs a single search request. The result of the
+        best query that found anything wins as soon as every better query has
+        come back empty, and the rest are cancelled. Returns None when there
+        is nothing to search for.
+        '''
+        plans = self.plan_queries(log, title, authors, identifiers)[:max(1, int(self.prefs['max_search_queries']))]
+        if not plans:
+            return None
+        negative_key = self.negative_key(title, authors, identifiers)
+        if self.known_negative(log, 'query', negative_key):
+            log.info('This query found nothing a short while ago, not searching again')
+            return []
+        if deadline is None:
+            deadline = Deadline(timeout, abort)
+        end = time.time() + self.prefs['search_time_budget']
+        hedge_delay = self.prefs['search_hedge_delay']
+        done = Queue()
+        pool = self.fetch_pool
+        tasks = []
+        results = {}
+        try:
+            while not deadline.expired('search') and time.time() < end:
+                for t in tasks:
+                    if t not in results:
+                        break
+                    if results[t]:
+                        log('Using query URL (%s):' % t.label, t.url)
+                        return results[t]
+                else:
+                    if len(tasks) == len(plans):
+                        if not any(t.failed for t in tasks):
+                            self.remember_negative(log, 'query', negative_key)
+                        return []
+                    last_sent = None
+                if len(tasks) < len(plans) and (last_sent is None or time.time() - last_sent >= hedge_delay):
+                    label, url = plans[len(tasks)]
+                    if last_sent is not None:
+                        log.debug('Earlier queries are slow, also searching (%s)' % label)
+                    tasks.append(pool.submit(SearchTask(label, url, title, done, timeout, log, self, deadline)))
+                    last_sent = time.time()
+                    continue
+                try:
+                    task, items = done.get(timeout=0.2)
+                except Empty:
+                    continue
+                results[task] = items
+            log.warning('Search stopped before every query finished')
+            for t in tasks:
+                if results.get(t):
+                    return results[t]
+            return []
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    def search_page_store(self, log, title, identifiers):
+        '''
+        Search hits from the saved pages, for offline mode: the pages with the
+        ISBN, or else those whose title matches.
+        '''
+        try:
+            found = self.page_store.find(title=title, isbn=check_isbn(identifiers.get('isbn', None)),
+                                         limit=max(1, int(self.prefs['max_search_results'])))
+        except Exception:
+            log.exception('Page store search failed')
+            return []
+        if found:
+            log.info('Found %d saved pages' % len(found))
+        return [dict(kyobo=kyobo, title=t or '', rating=0, author='') for kyobo, t in found]
+
+    def title_similarity(self, title, mi):
+        if title is None:
+            return 0
+        return TitleMatcher(title).score(mi.title)
+
+    def is_exact_match(self, mi, title, identifiers):
+        isbn = check_isbn(identifiers.get('isbn', None))
+        if isbn and check_isbn(mi.isbn) == isbn:
+            return True
+        # The volume number is part of the title, so this is title+volume
+        return bool(title) and cleanup_title(title) == cleanup_title(mi.title)
 
     def identify(self, log, result_queue, abort, title=None, authors=None,  # {{{
-                 identifiers={}, timeout=30):
+                 identifiers={}, timeout=30, deadline=None):
+        '''
+        timeout is the budget of the whole call, shared by its search,
+        detail and series requests. A caller that has its own Deadline passes
+        it as deadline and reports it; otherwise one is made here.
+        '''
+        own_deadline = deadline is None
+        if own_deadline:
+            deadline = Deadline(timeout, abort)
+        metrics = self.metrics
+        try:
+            with metrics.span('identify'):
+                self._identify(log, result_queue, abort, title, authors, identifiers, timeout, deadline)
+        finally:
+            if own_deadline:
+                deadline.report(log)
+                metrics.report(log)
 
-        print('iidentify', result_queue)
-        br = self.browser
-        br.addheaders = [
-            ('Referer', 'https://search.kyobobook.co.kr/'),
-            #('X-Requested-With', 'XMLHttpRequest'),
-            #('Cache-Control', 'no-cache'),
-            #('Pragma', 'no-cache'),
-            #('verify_ssl', 'True'),
-            ("User-Agent", "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) "
-                           "Version/14.1 Safari/605.1.15"),
-        ]
+    def _identify(self, log, result_queue, abort, title, authors, identifiers, timeout, deadline):
+        known = None
+        if 'kyobo' not in identifiers and 'kyobobook.co.kr' not in identifiers:
+            known = self.find_known(log, title, authors, identifiers)
 
         if 'kyobo' in identifiers:
             items = [dict(kyobo=identifiers['kyobo'])]
         elif 'kyobobook.co.kr' in identifiers:
             items = [dict(kyobo=identifiers['kyobobook.co.kr'])]
+        elif known:
+            log.info('Found in lookup index, skipping search:', known)
+            items = [dict(kyobo=known)]
         else:
-            log.info('hey', title)
-            query = self.create_query(log, title=title, authors=authors,
-                                      identifiers=identifiers)
-            if not query:
-                log.error('Insufficient metadata to construct query')
-                return
-            log('Using query URL@1:', query)
-            try:
-                raw = br.open(query, timeout=timeout).read().decode('utf-8')
-            except Exception as e:
-                log.exception('Failed to make identify query: %r' % query)
-                return as_unicode(e)
-
-            #f = open('\\workspace\\out.txt', "r")
-            #raw = f.read()
-            #f.close()
-            items = self.parseList(raw, log, title)
-            print('parseList', items)
-
-            if len(items) == 0:
-                sp = title.split(" ")
-                title2 = " ".join(sp[1:3])
-                #title2 = title2 + " " + authors
-                return self.identify(log, result_queue, abort, title=title2, authors=authors, timeout=timeout)
-
+            items = self.search_page_store(log, title, identifiers) if self.prefs['offline'] else None
+            isbn = check_isbn(identifiers.get('isbn', None))
+            search_identifiers = identifiers
+            if not items and isbn:
+                kyobo = self.resolve_isbns(log, [isbn], abort, timeout, deadline).get(isbn)
+                if kyobo:
+                    log.info('ISBN %s is %s, skipping search' % (isbn, kyobo))
+                    items = [dict(kyobo=kyobo)]
+                elif kyobo is None:
+                    # The lookup failed, so the ISBN query is still worth a try
+                    log.info('Could not look up ISBN %s, searching instead' % isbn)
+                elif not title:
+                    log.info('No book with ISBN %s on Kyobo' % isbn)
+                    return
+                else:
+                    # Searching for the ISBN again would not find it either
+                    search_identifiers = {k: v for k, v in iteritems(identifiers) if k != 'isbn'}
+            if not items:
+                items = self.search(log, abort, title, authors, search_identifiers, timeout, deadline)
             if items is None:
-                log.error('Failed to get list of matching items')
-                log.debug('Response text:')
-                log.debug(raw)
+                log.error('Insufficient metadata to construct query')
                 return
 
-
-        if (not items and identifiers and title and authors and
-                not abort.is_set()):
-            return self.identify(log, result_queue, abort, title=title, authors=authors, timeout=timeout)
         if not items:
             return
 
-
-        newQ = Queue() 
+        if self.prefs['merge_editions'] and len(items) > 1:
+            clusters = cluster_editions(items, self.prefs['preferred_edition'])
+            skipped = len(items) - len(clusters)
+            if skipped:
+                log.info('Fetching %d of %d hits, the others are other editions of the same books' % (
+                    len(clusters), len(items)))
+                KyoboKr._metrics.count('detail.editions_skipped', skipped)
+            items = clusters
+
+        newQ = Queue()
+        top_k = int(self.prefs['top_k'])
+        wave_size = top_k if top_k > 0 else len(items)
+        threshold = self.prefs['confidence_threshold']
+        stream = self.prefs['stream_results']
+        enrich = self.prefs['enrich_comments']
+        metrics = KyoboKr._metrics
+        matcher = TitleMatcher(title) if title != None else None
+        pool = self.fetch_pool
+        pending = list(enumerate(items))
         workers = []
-        for i, item in enumerate(items):
-            print('@@@Work', i, item)
-            workers.append(Worker(item, i, newQ , br.clone_browser(), timeout, log, self))
-
-        if not workers:
-            return
-
-        for w in workers:
-            w.start()
-            # Don't send all requests at the same time
-            time.sleep(0.1)
-
-        #for w in workers:
-        #    w.join(5)
-
-        while not abort.is_set():
-            a_worker_is_alive = False
-            for w in workers:
-                w.join(0.2)
-                if abort.is_set():
+        found = []
+
+        def arrived(mi):
+            # Score on arrival so a streamed result carries its final relevance
+            if matcher is not None:
+                with metrics.span('score'):
+                    mi.source_relevance = matcher.score(mi.title) * 100
+            found.append(mi)
+            if enrich:
+                self.enrich_comments(log, mi, abort)
+            if stream:
+                result_queue.put(mi)
+
+        # Candidates are already sorted by parseList, so fetch them in waves
+        # of top_k and only go further down the list when nothing so far is
+        # a confident match. Every worker reports on newQ exactly once, so
+        # waiting is just counting arrivals.
+        while pending and not deadline.expired('detail'):
+            wave = [Worker(item, i, newQ, timeout, log, self, deadline) for i, item in pending[:wave_size]]
+            pending = pending[wave_size:]
+            workers.extend(wave)
+            for w in wave:
+                pool.submit(w)
+
+            exact = False
+            remaining = len(wave)
+            while remaining and not deadline.expired():
+                try:
+                    mi = newQ.get(timeout=0.5)
+                except Empty:
+                    continue
+                remaining -= 1
+                if mi is None:
+                    continue
+                arrived(mi)
+                if self.is_exact_match(mi, title, identifiers):
+                    exact = True
                     break
-                if w.is_alive():
-                    a_worker_is_alive = True
-            if not a_worker_is_alive:
+            if exact:
+                log.info('Exact match found, cancelling remaining candidates')
                 break
+            if matcher is not None and any(mi.source_relevance >= threshold for mi in found):
+                break
+        else:
+            if pending:
+                deadline.cut('detail', deadline.reason('detail'), '%d candidates not fetched' % len(pending))
 
-        books = []
-        items = []
-        sorted_books = []
-
-        #self.log('QUEUE ', len(workers), newQ.qsize(), result_queue.qsize())
-
-        while(newQ.qsize() > 0):
-            books.append( newQ.get() )
-
-        for item in books: 
-            answer_bytes = title
-            input_bytes = item.title
-            #answer_bytes_list = list(answer_bytes)
-            #input_bytes_list = list(input_bytes)
-
-            #maxlen = int(abs(len(answer_bytes_list) + len(input_bytes_list)) / 2)
-            #maxlen = int(len(answer_bytes_list)) + 1
-
-
-            input_string = input_bytes
-            if ":" in item.title:
-                input_string = str(input_bytes).split(':')[0]
+        reason = deadline.reason('detail')
+        for w in workers:
+            if reason is not None and not w.finished.is_set():
+                # Once cancelled, the worker only sees 'cancelled' and records nothing
+                deadline.cut('detail', reason, 'kyobo %s still being read' % w.kyobo)
+            w.cancel()
+        while True:
+            try:
+                mi = newQ.get_nowait()
+            except Empty:
+                break
+            if mi is not None:
+                arrived(mi)
 
-            similar = 0
+        with metrics.span('rank'):
+            sorted_books = Ranker(title, identifiers, self).rank(found)
+        self.remember(log, title, authors, identifiers, sorted_books)
 
-            if title != None:
-                check_len = len(answer_bytes) + 3
+        #self.log('sorted books @2: ',sorted_books )
 
-                sm = difflib.SequenceMatcher(None, answer_bytes, input_string[:check_len], autojunk=False)
-                similar = sm.ratio()
-                item.source_relevance = similar  * 100
-                
-            items.append({'item':item, 'score': similar * 100})
-            #self.log('ITEM SCORE : ', item.title, item.source_relevance )
+        if not stream:
+            for mi in sorted_books:
+                result_queue.put(mi)
+    # }}}
 
-        sorted_books = sorted(items, key=lambda x: x['score'], reverse=True)
+    def query_key(self, query):
+        identifiers = query.get('identifiers') or {}
+        kyobo = identifiers.get('kyobo') or identifiers.get('kyobobook.co.kr')
+        if kyobo:
+            return ('kyobo', kyobo)
+        title = query.get('title')
+        return (cleanup_title(title) if title else None, tuple(query.get('authors') or ()),
+                tuple(sorted(iteritems(query.get('identifiers') or {}))))
+
+    def identify_many(self, log, queries, abort, timeout=30):  # {{{
+        '''
+        Identify many books in one go. queries is a sequence of dicts holding
+        the title, authors and identifiers arguments of identify(). Yields
+        (index, results) as each query finishes, results being the list of
+        Metadata identify() put on its result queue for queries[index].
+
+        Identical queries and queries naming the same kyobo ID run once. All
+        queries share the fetch pool, the rate limiter and the response cache,
+        and concurrent fetches of the same page are collapsed into one.
+        '''
+        indices = {}
+        for i, query in enumerate(queries):
+            indices.setdefault(self.query_key(query), []).append(i)
+
+        metrics = self.metrics
+        size = self.prefs['batch_queries']
+        with KyoboKr._fetch_pool_lock:
+            if KyoboKr._query_pool is None:
+                KyoboKr._query_pool = FetchPool(size, lambda: None)
+            elif KyoboKr._query_pool.size != size:
+                KyoboKr._query_pool.resize(size)
+        pool = KyoboKr._query_pool
+
+        isbns = []
+        for key, idx in iteritems(indices):
+            identifiers = queries[idx[0]].get('identifiers') or {}
+            if identifiers.get('isbn') and not (identifiers.get('kyobo') or identifiers.get('kyobobook.co.kr')):
+                isbns.append(identifiers['isbn'])
+        if isbns:
+            # One batch up front, so that every query finds its answer remembered
+            self.resolve_isbns(log, isbns, abort, timeout)
+
+        done = Queue()
+        tasks = []
+        for key, idx in iteritems(indices):
+            q = queries[idx[0]]
+            tasks.append(pool.submit(QueryTask(key, dict(title=q.get('title'), authors=q.get('authors'),
+                identifiers=q.get('identifiers') or {}), done, abort, timeout, log, self)))
+        log.info('Batch of %d queries, %d after removing duplicates' % (len(queries), len(tasks)))
+
+        remaining = len(tasks)
+        try:
+            while remaining and not abort.is_set():
+                try:
+                    key, results = done.get(timeout=0.2)
+                except Empty:
+                    continue
+                remaining -= 1
+                for i in indices[key]:
+                    yield i, list(results)
+        finally:
+            for t in tasks:
+                t.cancel()
+            log.info('Request counters:', self.request_stats())
+            metrics.report(log)
+    # }}}
 
-        #self.log('sorted books @2: ',sorted_books )
+    def request_stats(self):
+        '''
+        Per-host request counters and current rates of the shared scheduler.
+        '''
+        return KyoboKr._scheduler.stats()
 
-        for b in sorted_books:
-            result_queue.put(b['item'])
+    cover_img_pat = re.compile(r'class="portrait_img_box[^"]*"[^>]*>\s*<img[^>]*?\ssrc="([^"]+)"')
+    cover_width_pat = re.compile(r'/fit-in/\d+x\d+/')
 
-        print('result_queue : ', result_queue.qsize())
-    # }}}
+    @property
+    def cover_store(self):
+        max_size = self.prefs['cover_cache_size'] * 1024 * 1024
+        with KyoboKr._response_cache_lock:
+            if KyoboKr._cover_store is None:
+                KyoboKr._cover_store = CoverStore(os.path.join(cache_dir(), 'kyobokr', 'covers'), max_size)
+            KyoboKr._cover_store.max_size = max_size
+        return KyoboKr._cover_store
+
+    def resolve_cover_url(self, br, log, identifiers, timeout, deadline=None):
+        '''
+        Find the cover URL of a book with the cheapest request possible: the
+        in-memory cover cache, then the detail page of a known kyobo ID (read
+        with a regular expression, usually from the response cache), then the
+        ISBN-based image URL Kyobo uses for paper books.
+        '''
+        cached_url = self.get_cached_cover_url(identifiers)
+        if cached_url is not None:
+            return cached_url
+        isbn = check_isbn(identifiers.get('isbn', None))
+        kyobo = identifiers.get('kyobo') or identifiers.get('kyobobook.co.kr')
+        if not kyobo and isbn:
+            kyobo = self.cached_isbn_to_identifier(isbn) or self.find_known(log, None, None, identifiers)
+        if kyobo:
+            try:
+                raw = self.fetch(br, log, 'detail', self._get_book_url(kyobo), timeout, key=kyobo,
+                                 validate=lambda raw: b'prod_title' in raw, deadline=deadline).decode('utf-8')
+            except Cancelled:
+                return None
+            except Exception:
+                log.exception('Failed to load item page for cover: %s' % kyobo)
+            else:
+                match = self.cover_img_pat.search(raw)
+                url = unescape(match.group(1)) if match else StructuredExtractor()(raw)['cover']
+                if url:
+                    self.cache_identifier_to_cover_url(kyobo, url)
+                    return url
+        if isbn:
+            return 'https://contents.kyobobook.co.kr/sih/fit-in/458x0/pdt/{}.jpg'.format(isbn)
+
+    def load_cover(self, br, log, url, timeout, get_best_cover=False, deadline=None):
+        '''
+        Return the image at url, or at its largest configured size variant
+        when get_best_cover is set, from the cover store or the network.
+        '''
+        urls = [url]
+        if get_best_cover and self.cover_width_pat.search(url):
+            urls.insert(0, self.cover_width_pat.sub('/fit-in/%dx0/' % self.prefs['best_cover_width'], url, 1))
+        for u in urls:
+            try:
+                cdata = self.cover_store.get(u)
+            except Exception:
+                log.exception('Cover store read failed')
+                cdata = None
+            KyoboKr._metrics.count('cover.store_hit' if cdata is not None else 'cover.store_miss')
+            if cdata is None:
+                log('Downloading cover from:', u)
+                try:
+                    cdata = self.fetch(br, log, 'cover', u, timeout, deadline=deadline)
+                except Cancelled:
+                    return None
+                except Exception:
+                    log.exception('Failed to download cover from:', u)
+                    continue
+                try:
+                    self.cover_store.put(u, cdata)
+                except Exception:
+                    log.exception('Cover store write failed')
+            if cdata:
+                return cdata
+
+    def prefetch_covers(self, log, kyobo_ids, abort, timeout=30, get_best_cover=False):
+        '''
+        Download the covers of many kyobo IDs in parallel on the fetch pool,
+        filling the cover store. Each cover gets a budget of timeout seconds
+        from when its download starts.
+        Returns a dict of kyobo ID to image bytes for the covers that could
+        be fetched.
+        '''
+        pool = self.fetch_pool
+        tasks = [pool.submit(CoverTask(k, timeout, log, self, get_best_cover, abort))
+                 for k in dict.fromkeys(kyobo_ids)]
+        for t in tasks:
+            while t.is_alive() and not abort.is_set():
+                t.join(0.2)
+        for t in tasks:
+            t.cancel()
+        return {t.kyobo: t.cdata for t in tasks if t.cdata}
 
     def download_cover(self, log, result_queue, abort,  # {{{
                        title=None, authors=None, identifiers={}, timeout=30, get_best_cover=False):
-        cached_url = self.get_cached_cover_url(identifiers)
+        deadline = Deadline(timeout, abort)
+        metrics = self.metrics
+        try:
+            with metrics.span('download_cover'):
+                self._download_cover(log, result_queue, abort, title, authors, identifiers, timeout, get_best_cover, deadline)
+        finally:
+            deadline.report(log)
+            metrics.report(log)
+
+    def _download_cover(self, log, result_queue, abort, title, authors, identifiers, timeout, get_best_cover, deadline):
+        br = self.prepare_browser(self.browser)
+        cached_url = self.resolve_cover_url(br, log, identifiers, timeout, deadline)
+        if cached_url is not None and not abort.is_set():
+            cdata = self.load_cover(br, log, cached_url, timeout, get_best_cover, deadline)
+            if cdata:
+                result_queue.put((self, cdata))
+                return
+            cached_url = None
         if cached_url is None:
+            if deadline.expired():
+                return
             log.info('No cached cover found, running identify')
             rq = Queue()
             self.identify(log, rq, abort, title=title, authors=authors,
-                          identifiers=identifiers)
+                          identifiers=identifiers, timeout=timeout, deadline=deadline)
             if abort.is_set():
                 return
             results = []
@@ -695,107 +3449,556 @@ class KyoboKr(Source):
 
         if abort.is_set():
             return
-        br = self.browser
-        log('Downloading cover from:', cached_url)
-        try:
-            cdata = br.open_novisit(cached_url, timeout=timeout).read()
+        cdata = self.load_cover(br, log, cached_url, timeout, get_best_cover, deadline)
+        if cdata:
             result_queue.put((self, cdata))
-        except:
-            log.exception('Failed to download cover from:', cached_url)
     # }}}
 
-class InternalMetadataCompareKeyGen:
+# }}}
 
+def benchmark_parse(paths, repeat=5):  # {{{
     '''
-    Generate a sort key for comparison of the relevance of Metadata objects,
-    given a search query. This is used only to compare results from the same
-    metadata source, not across different sources.
+    Print the CPU time ItemPageExtractor spends per saved detail page, for a
+    full-page parse and for the body-region parse. Run it with:
 
-    The sort key ensures that an ascending order sort is a sort by order of
-    decreasing relevance.
+        calibre-debug -e __init__.py bench-parse <page.html or directory> ...
+    '''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.html')))
+        else:
+            files.append(path)
+    pages = []
+    for f in files:
+        with open(f, 'rb') as stream:
+            pages.append(stream.read().decode('utf-8'))
+    if not pages:
+        print('No pages to benchmark')
+        return 1
+
+    for label, extract in (('full page', ItemPageExtractor(region=False)), ('body region', ItemPageExtractor(region=True))):
+        missing = 0
+        start = time.process_time()
+        for i in range(repeat):
+            for raw in pages:
+                if extract(raw) is None:
+                    missing += 1
+        elapsed = time.process_time() - start
+        print('%-12s %8.2f ms/page  (%d pages x %d, %d without title)' % (
+            label, elapsed * 1000 / (len(pages) * repeat), len(pages), repeat, missing // repeat))
+
+    # Throughput in wall time, as a batch sees it, in this process and in a ParsePool
+    data = [raw.encode('utf-8') for raw in pages] * repeat
+    start = time.time()
+    for raw in data:
+        extract_record(raw)
+    print('%-12s %8.1f pages/s' % ('in process', len(data) / (time.time() - start)))
+    processes = os.cpu_count() or 1
+    if processes > 1 and ParsePool.available():
+        pool = ParsePool(processes)
+        try:
+            list(pool.executor.map(extract_record, data[:processes]))
+            start = time.time()
+            list(pool.executor.map(extract_record, data, chunksize=4))
+            print('%-12s %8.1f pages/s' % ('%d processes' % processes, len(data) / (time.time() - start)))
+        finally:
+            pool.shutdown()
+    return 0
 
-    The algorithm is:
+# }}}
 
-        * Prefer results that have at least one identifier the same as for the query
-        * Prefer results with a cached cover URL
-        * Prefer results with all available fields filled in
-        * Prefer results with the same language as the current user interface language
-        * Prefer results that are an exact title match to the query
-        * Prefer results with longer comments (greater than 10% longer)
-        * Use the relevance of the result as reported by the metadata source's search
-           engine
+# Search titles as they come back from Kyobo, with the one a query should pick
+similarity_cases = [
+    ('귀멸의칼날 23', ['귀멸의 칼날 22', '귀멸의 칼날 23', '귀멸의 칼날 외전', '귀멸의 칼날 23 특장판 세트'], 1),
+    ('귀멸의 칼날 2', ['귀멸의 칼날 22', '귀멸의 칼날 12', '귀멸의 칼날 2', '귀멸의 칼날 21'], 2),
+    ('원피스 105', ['원피스 104', '원피스 105: 루피의 꿈', '원피스 필름 레드', '원피스 1'], 1),
+    ('진격의 거인 01권', ['진격의 거인 10', '진격의 거인 1', '진격의 거인 11', '진격의 거인 외전 1'], 1),
+    ('토지 3', ['토지 1부 3권', '토지 3', '토지 13', '토지 30'], 1),
+    ('해리 포터와 마법사의 돌', ['해리 포터와 비밀의 방', '해리포터와 마법사의 돌 1', '해리 포터와 불의 잔'], 1),
+    ('채식주의자', ['채식주의자(리커버 에디션)', '채식주의자의 식탁', '소년이 온다'], 0),
+    ('나 혼자만 레벨업 5', ['나 혼자만 레벨업 15', '나 혼자만 레벨업 5', '나 혼자만 레벨업 50', '나 혼자 산다'], 1),
+    ('슬램덩크 신장재편판 10', ['슬램덩크 신장재편판 1', '슬램덩크 신장재편판 10', '슬램덩크 오리지널 10', '더 퍼스트 슬램덩크'], 1),
+    ('코스모스', ['코스모스 (양장)', '코스모스: 가능한 세계들', '코스모스 특별판'], 0),
+    ('귀멸의 칼날 23', ['귀멸의 칼날 1-23권 세트', '귀멸의 칼날 23 특장판', '귀멸의 칼날 전23권', '귀멸의 칼날 22'], 1),
+]
+
+def benchmark_similarity(repeat=200):  # {{{
+    '''
+    Compare TitleMatcher with the byte-level difflib scoring it replaced on
+    similarity_cases, for top-1 accuracy and time per scored title. Run it
+    with: calibre-debug -e __init__.py bench-similarity
     '''
+    import difflib
+
+    def difflib_scores(query, titles):
+        answer = list(bytes(query, 'utf-8'))
+        return [difflib.SequenceMatcher(None, answer, list(bytes(t, 'utf-8'))).ratio() for t in titles]
+
+    engines = (('difflib', difflib_scores), ('jamo n-gram', lambda q, titles: TitleMatcher(q).scores(titles)))
+    count = sum(len(titles) for q, titles, best in similarity_cases)
+    subtitle = ': 새로운 세계로 떠나는 모험과 그 뒤에 숨겨진 이야기, 작가 인터뷰를 더한 특별 한정 소장판'
+    long_cases = [(q, [t + subtitle for t in titles], best) for q, titles, best in similarity_cases]
+    for label, scorer in engines:
+        correct = 0
+        for query, titles, best in similarity_cases:
+            scores = scorer(query, titles)
+            if max(range(len(titles)), key=scores.__getitem__) == best:
+                correct += 1
+        timings = []
+        for cases in (similarity_cases, long_cases):
+            start = time.process_time()
+            for i in range(repeat):
+                normalize_title.cache_clear()
+                for query, titles, best in cases:
+                    scorer(query, titles)
+            timings.append((time.process_time() - start) * 1e6 / (count * repeat))
+        print('%-12s %2d/%d correct  %7.1f us/title  %7.1f us/long title' % (
+            label, correct, len(similarity_cases), timings[0], timings[1]))
+    return 0
 
-    def __init__(self, mi, source_plugin, title, authors, identifiers):
-        same_identifier = 2
-        idents = mi.get_identifiers()
-        for k, v in iteritems(identifiers):
-            if idents.get(k) == v:
-                same_identifier = 1
-                break
+# }}}
 
-        all_fields = 1 if source_plugin.test_fields(mi) is None else 2
+def benchmark_ranking(size=50, repeat=20):  # {{{
+    '''
+    Time Ranker on result lists of size Metadata built from
+    similarity_cases, with tuple keys and with a cmp-style comparator that
+    recomputes the features on every comparison, and check that the
+    expected title ranks first. Run it with:
 
-        exact_title = 1 if title and \
-                cleanup_title(title) == cleanup_title(mi.title) else 2
+        calibre-debug -e __init__.py bench-rank [size]
+    '''
+    from functools import cmp_to_key
+    from calibre.ebooks.metadata.book.base import Metadata
+
+    plugin = KyoboKr(None)
+    cases = []
+    for query, titles, best in similarity_cases:
+        results = []
+        for i in range(size):
+            t = titles[i % len(titles)]
+            mi = Metadata(t, ['작가'])
+            mi.set_identifier('kyobo', 'S%012d' % i)
+            mi.comments = '소개 ' * (i % 7 * 20)
+            results.append((mi, i % len(titles) == best))
+        cases.append((query, results))
+
+    def by_tuple(ranker, mis):
+        return ranker.rank(mis)
+
+    def by_cmp(ranker, mis):
+        def compare(a, b):
+            x, y = ranker.key(a), ranker.key(b)
+            return (x > y) - (x < y)
+        return sorted(mis, key=cmp_to_key(compare))
+
+    for label, rank in (('tuple keys', by_tuple), ('cmp objects', by_cmp)):
+        correct = 0
+        start = time.process_time()
+        for i in range(repeat):
+            for query, results in cases:
+                ranked = rank(Ranker(query, {}, plugin), [mi for mi, expected in results])
+                if i == 0 and dict((id(mi), expected) for mi, expected in results)[id(ranked[0])]:
+                    correct += 1
+        elapsed = time.process_time() - start
+        print('%-12s %2d/%d correct  %7.1f us/candidate  (%d candidates per query)' % (
+            label, correct, len(cases), elapsed * 1e6 / (repeat * len(cases) * size), size))
+    return 0
 
-        language = 1
-        if mi.language:
-            mil = canonicalize_lang(mi.language)
-            if mil != 'und' and mil != canonicalize_lang(get_lang()):
-                language = 2
+# }}}
 
-        has_cover = 2 if (not source_plugin.cached_cover_url_is_reliable or
-                source_plugin.get_cached_cover_url(mi.identifiers) is None) else 1
+# Record and replay {{{
+# Recorded Kyobo responses live in a fixtures directory: one file per
+# response under a folder per endpoint, and manifest.json listing the URL,
+# endpoint and file of each, together with the queries they were recorded
+# for. StandInServer replays them over HTTP so that identify() can be
+# benchmarked without touching the network.
 
-        print('####self.base ', mi.title, mi.identifiers, mi.source_relevance)
-        self.base = (same_identifier, has_cover, all_fields, language, exact_title)
-        self.comments_len = len((mi.comments or '').strip())
-        self.extra = getattr(mi, 'source_relevance', 0)
+class FixtureRecorder(object):
 
-    def compare_to_other(self, other):
-        try:
-            if self.extra != other.extra:
-                print('extra, ', self.base, self.extra, other.base, other.extra )
-                return other.extra - self.extra
-                #return self.extra - other.extra
-            else:
-                print('extra@2, ', self.base, self.extra, other.base, other.extra )
-        except:
-            pass
+    '''
+    Collects every response KyoboKr.fetch() downloads while it is set as
+    KyoboKr._recorder, and writes them out as a fixtures directory.
+    '''
+
+    extensions = {'search': '.html', 'detail': '.html', 'series': '.json', 'cover': '.jpg'}
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = Lock()
+        self.entries = {}
+
+    def add(self, endpoint, url, raw):
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16] + self.extensions.get(endpoint, '')
+        path = os.path.join(self.root, endpoint, name)
+        with self.lock:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(raw)
+            self.entries[url] = dict(url=url, endpoint=endpoint, file=endpoint + '/' + name, size=len(raw))
+
+    def save(self, queries):
+        with self.lock:
+            manifest = dict(queries=queries, entries=sorted(self.entries.values(), key=lambda e: e['url']))
+        with open(os.path.join(self.root, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+
+class FixtureSet(object):
+
+    '''
+    A recorded fixtures directory, read back.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, 'manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        self.queries = manifest['queries']
+        self.entries = {e['url']: e for e in manifest['entries']}
+
+    def body(self, url):
+        entry = self.entries.get(url)
+        if entry is None:
+            return None
+        with open(os.path.join(self.root, entry['file']), 'rb') as f:
+            return f.read()
+
+    def urls(self, endpoint):
+        return sorted(url for url, e in iteritems(self.entries) if e['endpoint'] == endpoint)
+
+class StandInServer(object):
+
+    '''
+    Serves a FixtureSet over HTTP/1.1 with keep-alive on 127.0.0.1. A Kyobo
+    URL https://<host>/<path> is served at <self.url>/<host>/<path>, which
+    is the rewrite KyoboKr.fetch() applies while KyoboKr._upstream is set.
+    Unrecorded URLs get a 404. latency seconds are added to every response
+    to stand in for the network round trip.
+    '''
+
+    content_types = {'search': 'text/html; charset=utf-8', 'detail': 'text/html; charset=utf-8',
+                     'series': 'application/json; charset=utf-8', 'cover': 'image/jpeg'}
+
+    def __init__(self, fixtures, latency=0):
+        self.fixtures, self.latency = fixtures, latency
+        self.server = None
+        self.url = None
+
+    def start(self, port=0):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        fixtures, latency, content_types = self.fixtures, self.latency, self.content_types
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = 'https:/' + self.path
+                body = fixtures.body(url)
+                if latency:
+                    time.sleep(latency)
+                if body is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_types.get(fixtures.entries[url]['endpoint'], 'text/html'))
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        t = Thread(target=self.server.serve_forever, name='KyoboKr-stand-in')
+        t.daemon = True
+        t.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        return self.url
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+def bench_plugin(**overrides):
+    '''
+    A KyoboKr for recording and benchmarks. Its settings live in memory and
+    never touch the user's configuration; the response cache, including
+    remembered failures and descriptions, and the lookup index are off and
+    covers go to a temporary store. overrides replace
+    individual settings.
+    '''
+    import tempfile
+
+    class BenchPrefs(dict):
+        # Looks up defaults like calibre's JSONConfig
+        defaults = {}
+
+        def __missing__(self, key):
+            return self.defaults[key]
+
+        def get(self, key, default=None):
+            return self[key] if key in self or key in self.defaults else default
+
+    prefs = BenchPrefs(cache_ttl_search=0, cache_ttl_detail=0, cache_ttl_series=0, cache_ttl_comments=0,
+                       negative_cache_ttl=0, use_lookup_index=False)
+    prefs.update(overrides)
+    store = CoverStore(tempfile.mkdtemp(prefix='kyobokr-bench-'), 100 * 1024 * 1024)
+
+    class BenchKyoboKr(KyoboKr):
+
+        @property
+        def prefs(self):
+            return prefs
+
+        @property
+        def cover_store(self):
+            return store
+
+    return BenchKyoboKr(None)
+
+def read_queries(path):
+    '''
+    Queries from a text file, one per line: a title, optionally followed by
+    a tab and comma separated authors. Blank lines and # comments are skipped.
+    '''
+    queries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            title, _, authors = line.partition('\t')
+            queries.append(dict(title=title.strip(), authors=[a.strip() for a in authors.split(',') if a.strip()]))
+    return queries
+
+def record_fixtures(root, queries_path, timeout=30):
+    '''
+    Run identify() against the live site for every query in queries_path and
+    download the cover of each best result, recording all responses into
+    root. Run it with:
+
+        calibre-debug -e __init__.py record <fixtures dir> <queries.txt>
+    '''
+    from calibre.utils.logging import ThreadSafeLog
+    log = ThreadSafeLog(level=ThreadSafeLog.WARN)
+    queries = read_queries(queries_path)
+    plugin = bench_plugin()
+    br = plugin.prepare_browser(plugin.browser)
+    recorder = KyoboKr._recorder = FixtureRecorder(root)
+    series_done = set()
+    try:
+        for i, query in enumerate(queries):
+            rq, abort = Queue(), Event()
+            plugin.identify(log, rq, abort, title=query['title'], authors=query['authors'] or None,
+                            identifiers={}, timeout=timeout)
+            results = []
+            while not rq.empty():
+                results.append(rq.get_nowait())
+            # Which search variants finish before the first good one cancels
+            # the rest depends on timing, a replay may run any of them
+            for label, url in plugin.plan_queries(log, query['title'], query['authors'] or None, {}):
+                if url not in recorder.entries:
+                    try:
+                        plugin.fetch(br, log, 'search', url, timeout)
+                    except Exception:
+                        log.exception('Failed to record search page: %s' % url)
+            kyobo_ids = [mi.identifiers['kyobo'] for mi in results if mi.identifiers.get('kyobo')]
+            # identify() skips the series list of volumes it has seen the
+            # series of, a replay starting cold needs them all
+            for kyobo in kyobo_ids:
+                if kyobo not in series_done:
+                    series_done.add(kyobo)
+                    worker = Worker(dict(kyobo=kyobo), 0, Queue(), timeout, log, plugin, Deadline(timeout))
+                    worker.br = br
+                    try:
+                        worker.fetchSeries()
+                    except Exception:
+                        log.exception('Failed to record series list for kyobo: %s' % kyobo)
+            plugin.prefetch_covers(log, kyobo_ids[:1], abort, timeout=timeout)
+            print('%4d/%d  %-40s %d results' % (i + 1, len(queries), query['title'], len(results)))
+    finally:
+        KyoboKr._recorder = None
+        recorder.save(queries)
+    print('Recorded %d responses into %s' % (len(recorder.entries), root))
+    return 0
+
+def percentile(values, p):
+    if not values:
         return 0
-                
-        a = cmp(self.base, other.base)
-        if a != 0:
-            return a
-        cx, cy = self.comments_len, other.comments_len
-        if cx and cy:
-            t = (cx + cy) / 20
-            delta = cy - cx
-            if abs(delta) > t:
-                return -1 if delta < 0 else 1
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
 
-    def __eq__(self, other):
-        return self.compare_to_other(other) == 0
+def peak_memory():
+    '''
+    Peak resident set size of this process in MB, or None where the resource
+    module is missing.
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    import sys
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
 
-    def __ne__(self, other):
-        return self.compare_to_other(other) != 0
+def benchmark_replay(root, latency=0, repeat=3, timeout=30):  # {{{
+    '''
+    Benchmark against a recorded fixtures directory, without network access.
+    The parsers run directly on the recorded pages: parseList on search
+    pages, Worker.extract on detail pages and get_series_info and SeriesInfo
+    on series lists. identify(), Worker.parseItemPage and identify_many()
+    run against a StandInServer that adds latency seconds per response.
+    Prints throughput, latency percentiles and peak memory. Run it with:
+
+        calibre-debug -e __init__.py bench-replay <fixtures dir> [latency]
+    '''
+    from calibre.utils.logging import ThreadSafeLog
+    try:
+        from urllib.parse import parse_qs
+    except ImportError:
+        from urlparse import parse_qs
+    log = ThreadSafeLog(level=ThreadSafeLog.ERROR)
+    fixtures = FixtureSet(root)
+    plugin = bench_plugin(max_requests_per_second=0)
+    print('%d queries, %s' % (len(fixtures.queries), ', '.join(
+        '%d %s' % (len(fixtures.urls(e)), e) for e in ('search', 'detail', 'series', 'cover'))))
+
+    def report(label, timings, unit='ms', scale=1000):
+        if not timings:
+            print('%-22s no samples' % label)
+            return
+        total = sum(timings)
+        print('%-22s %6d  %8.1f/s  p50 %8.2f %s  p90 %8.2f %s  p99 %8.2f %s' % (
+            label, len(timings), len(timings) / total if total else 0, percentile(timings, 50) * scale, unit,
+            percentile(timings, 90) * scale, unit, percentile(timings, 99) * scale, unit))
+
+    def timed(func, *args):
+        start = time.perf_counter()
+        func(*args)
+        return time.perf_counter() - start
+
+    pages = []
+    for url in fixtures.urls('search'):
+        keyword = (parse_qs(urlparse(url).query).get('keyword') or [''])[0]
+        pages.append((fixtures.body(url), keyword))
+    report('parseList', [timed(plugin.parseList, raw, log, keyword) for i in range(repeat) for raw, keyword in pages])
+
+    worker = Worker(dict(kyobo='S000000000000'), 0, Queue(), timeout, log, plugin, Deadline(timeout))
+    details = [fixtures.body(url).decode('utf-8') for url in fixtures.urls('detail')]
+    report('detail extract', [timed(worker.extract, raw) for i in range(repeat) for raw in details])
+
+    series = []
+    for url in fixtures.urls('series'):
+        try:
+            names = [item['name'] for item in json.loads(fixtures.body(url))['data'].get('list') or []]
+        except (ValueError, KeyError, TypeError):
+            continue
+        series.extend((name, names) for name in names)
+    report('get_series_info', [timed(get_series_info, title, names)
+                               for i in range(repeat) for title, names in series], 'us', 1e6)
+    report('SeriesInfo', [timed(lambda t, n: SeriesInfo(n).lookup(t), title, names)
+                          for i in range(repeat) for title, names in series], 'us', 1e6)
+
+    server = StandInServer(fixtures, latency)
+    KyoboKr._upstream = server.start()
+    try:
+        br = plugin.prepare_browser(plugin.browser)
+        timings = []
+        for url in fixtures.urls('detail'):
+            KyoboKr._series_cache = SeriesCache()
+            w = Worker(dict(kyobo=getItemID(url)), 0, Queue(), timeout, log, plugin, Deadline(timeout))
+            w.br = br
+            timings.append(timed(w.parseItemPage, url))
+        report('parseItemPage', timings)
+
+        for label in ('identify (cold)', 'identify (warm)'):
+            if label.endswith('(cold)'):
+                KyoboKr._series_cache = SeriesCache()
+            timings, found = [], 0
+            for query in fixtures.queries:
+                rq = Queue()
+                timings.append(timed(lambda: plugin.identify(log, rq, Event(), title=query['title'],
+                    authors=query['authors'] or None, identifiers={}, timeout=timeout)))
+                found += not rq.empty()
+            report(label, timings)
+            print('%-22s %d/%d found' % ('', found, len(fixtures.queries)))
+
+        KyoboKr._series_cache = SeriesCache()
+        queries = [dict(title=q['title'], authors=q['authors'] or None, identifiers={}) for q in fixtures.queries]
+        start = time.perf_counter()
+        done = sum(1 for i, results in plugin.identify_many(log, queries, Event(), timeout=timeout))
+        elapsed = time.perf_counter() - start
+        print('%-22s %6d  %8.1f/s  %.2f s total' % ('identify_many', done, done / elapsed if elapsed else 0, elapsed))
+    finally:
+        KyoboKr._upstream = None
+        server.stop()
+
+    peak = peak_memory()
+    if peak is not None:
+        print('peak memory            %.1f MB' % peak)
+    return 0
 
-    def __lt__(self, other):
-        return self.compare_to_other(other) < 0
+# }}}
 
-    def __le__(self, other):
-        return self.compare_to_other(other) <= 0
+def ingest_pages(paths):
+    '''
+    Add saved detail pages and series lists to the configured page store.
+    Run it with:
 
-    def __gt__(self, other):
-        return self.compare_to_other(other) > 0
+        calibre-debug -e __init__.py ingest <page.html, .json or directory> ...
+    '''
+    from calibre.utils.logging import ThreadSafeLog
+    log = ThreadSafeLog(level=ThreadSafeLog.INFO)
+    store = KyoboKr(None).page_store
+    added = store.ingest(paths, log)
+    print('Added %d pages to %s' % (added, store.root))
+    return 0
+
+def serve_fixtures(root, port=8000, latency=0):
+    '''
+    Serve a fixtures directory until interrupted, for benchmarks driven from
+    outside this file. Run it with:
 
-    def __ge__(self, other):
-        return self.compare_to_other(other) >= 0
+        calibre-debug -e __init__.py serve <fixtures dir> [port] [latency]
+    '''
+    server = StandInServer(FixtureSet(root), latency)
+    print('Serving %s at %s' % (root, server.start(port)))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+    return 0
 
 # }}}
 
 if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench-parse':
+        sys.exit(benchmark_parse(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench-similarity':
+        sys.exit(benchmark_similarity())
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench-rank':
+        sys.exit(benchmark_ranking(*[int(x) for x in sys.argv[2:3]]))
+    if len(sys.argv) > 2 and sys.argv[1] == 'ingest':
+        sys.exit(ingest_pages(sys.argv[2:]))
+    if len(sys.argv) > 3 and sys.argv[1] == 'record':
+        sys.exit(record_fixtures(sys.argv[2], sys.argv[3]))
+    if len(sys.argv) > 2 and sys.argv[1] == 'serve':
+        sys.exit(serve_fixtures(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 8000,
+                                float(sys.argv[4]) if len(sys.argv) > 4 else 0))
+    if len(sys.argv) > 2 and sys.argv[1] == 'bench-replay':
+        sys.exit(benchmark_replay(sys.argv[2], *[float(x) for x in sys.argv[3:4]]))
+
     from calibre.ebooks.metadata.sources.test import (
         test_identify_plugin, title_test, authors_test, comments_test, pubdate_test, series_test)
 